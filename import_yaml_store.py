@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+""" One-shot migration of the yaml data files into the sqlite data store. """
+
+import sys
+import os.path
+
+from lib.config import load_config
+from lib.store import ApplicationStore
+from lib.store._backend import YamlBackend, SqliteBackend, DEFAULT_SQLITE_FILE
+
+# the tables to migrate: (store, name, yaml section, key field)
+TABLES = [
+    ("users", "student_users", "users", "username"),
+    ("lab", "lab", "lab", None),
+    ("admin", "admin_auth", "auth", None),
+]
+
+
+def main():
+    config = dict(ApplicationStore.DEFAULT_CONFIG)
+    config.update(load_config().get("data_store", None) or {})
+    db_file = os.path.join(config["path"], config.get("sqlite_file", DEFAULT_SQLITE_FILE))
+
+    source = YamlBackend(config["path"])
+    target = SqliteBackend(db_file)
+    try:
+        for store, name, section, key_field in TABLES:
+            # note: the stores' files may be overridden (as in `ApplicationStore`)
+            path = (config.get(store, None) or {}).get("path", config["path"])
+            rows = source.table(name, section=section, key_field=key_field, path=path).load()
+            target.table(name).put_many(rows)
+            print("%s: imported %i rows" % (name, len(rows)))
+    finally:
+        target.close()
+    print("Done! Set `data_store.backend: sqlite` in the config to use %s" % db_file)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,26 +1,92 @@
 """ Implements AWS API helpers. """
 
+from threading import Lock
+
 import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
+
+from .ratelimit import RATE_LIMITERS
+
+
+# default botocore client options (overridden by the `aws.client` config)
+DEFAULT_CLIENT_CONFIG = {
+    "max_pool_connections": 10,
+    "tcp_keepalive": True,
+    "retries": {"mode": "standard", "max_attempts": 3},
+}
 
 
 class AwsAPIHelper():
-    """ An API helper class (initialized once per thread) """
-    
+    """ An API helper class (initialized once per thread).
+
+    The low level clients are cached (per service) and reused across the tasks executed by
+    the thread, so are their HTTPS connections. Call `invalidate_all()` after the credentials
+    were rotated. """
+
+    # incremented to invalidate the cached sessions / clients of all helpers
+    _generation = 0
+    _generation_lock = Lock()
+
     def __init__(self, aws_config):
         self._config = aws_config
-        self._session = self._new_session()
+        self._session = None
+        self._clients = {}
+        self._session_generation = None
+        self._refresh_session()
 
     @property
     def session(self):
+        self._refresh_session()
         return self._session
 
     def client(self, name, **kwargs):
-        """ Returns a specific AWS low level client. """
-        return self._session.client(name, **kwargs)
+        """ Returns a specific AWS low level client (cached, rate limited). """
+        self._refresh_session()
+        key = (name, tuple(sorted(kwargs.items())))
+        client = self._clients.get(key, None)
+        if client is None:
+            kwargs.setdefault("config", self._client_config())
+            client = self._session.client(name, **kwargs)
+            RATE_LIMITERS.install(client)
+            self._clients[key] = client
+        return client
 
     def resource(self, name, **kwargs):
-        """ Returns a specific AWS resource. """
-        return self._session.resource(name, **kwargs)
+        """ Returns a specific AWS resource (rate limited). """
+        self._refresh_session()
+        kwargs.setdefault("config", self._client_config())
+        resource = self._session.resource(name, **kwargs)
+        RATE_LIMITERS.install(resource.meta.client)
+        return resource
+
+    @classmethod
+    def invalidate_all(cls):
+        """ Invalidates the sessions and clients of all helpers (e.g., on credentials
+        rotation); they are re-created on their next use. """
+        with cls._generation_lock:
+            cls._generation += 1
+
+    def _refresh_session(self):
+        """ Re-creates the session if it was invalidated. """
+        if self._session_generation != AwsAPIHelper._generation:
+            self._session_generation = AwsAPIHelper._generation
+            self._session = self._new_session()
+            self._clients = {}
+
+    def _client_config(self):
+        return self.build_client_config(self._config)
+
+    @staticmethod
+    def build_client_config(aws_config):
+        """ Returns the botocore client config (the defaults + the `aws.client` options).
+        Raises `ValueError` for invalid options (call it when loading the config). """
+        options = dict(DEFAULT_CLIENT_CONFIG)
+        options.update(aws_config.get("client", None) or {})
+        try:
+            return Config(**options)
+        except (TypeError, BotoCoreError) as exc:
+            raise ValueError("Invalid aws.client options: %s" % str(exc))
 
     def _new_session(self, **extra_options):
         options = {
@@ -30,4 +96,3 @@ class AwsAPIHelper():
         }
         options.update(extra_options)
         return boto3.session.Session(**options)
-
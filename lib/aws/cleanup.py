@@ -0,0 +1,360 @@
+""" Dependency graph-based (parallel) AWS resources cleanup engine. """
+
+import time
+import logging
+from threading import Lock
+from collections.abc import Mapping
+from concurrent.futures import Future
+
+from .retry import classify_error
+from .tasks import DeleteResourceTask, TerminateInstancesTask, RetrieveResourceStates
+
+log = logging.getLogger(__name__)
+
+
+# The links (see `AWSResource.links`) which require the linked resource to be deleted first:
+# (resource type, linked resource type). For all other links, the resource itself needs to be
+# deleted before the linked one (e.g., an instance before its subnet / VPC / security group).
+DELETE_LINKED_FIRST = {
+    ("NetworkInterfaces", "Instances"),
+    ("Addresses", "Instances"),
+    ("Addresses", "NetworkInterfaces"),
+}
+
+
+class CleanupNode():
+    """ A resource to delete + its dependency edges. """
+    __slots__ = ("resource", "prerequisites", "dependents")
+
+    def __init__(self, resource):
+        self.resource = resource
+        self.prerequisites = set()  # the nodes to delete before this one
+        self.dependents = set()  # the nodes waiting for this one
+
+    @property
+    def key(self):
+        return (self.resource.res_type, self.resource.id)
+
+
+class CleanupGraph():
+    """ The dependency graph of the resources to delete. """
+
+    def __init__(self, resource_map):
+        self.nodes = {}
+        for resources in resource_map.values():
+            for resource in resources:
+                node = CleanupNode(resource)
+                self.nodes[node.key] = node
+        for node in self.nodes.values():
+            for link in node.resource.links:
+                linked = self.nodes.get(link, None)
+                if linked is None or linked is node:
+                    continue  # not to be deleted
+                if (node.resource.res_type, link[0]) in DELETE_LINKED_FIRST:
+                    self._add_edge(linked, node)
+                else:
+                    self._add_edge(node, linked)
+        self._break_cycles()
+
+    @staticmethod
+    def _add_edge(first, then):
+        then.prerequisites.add(first.key)
+        first.dependents.add(then.key)
+
+    def _break_cycles(self):
+        """ Drops an edge of each dependency cycle (should not happen, but the AWS data may be
+        inconsistent), until all nodes can become ready. The nodes only waiting for a cycle
+        (downstream of it) keep their edges. """
+        while True:
+            blocked = self._blocked_nodes()
+            if not blocked:
+                return
+            for component in self._strong_components(blocked):
+                key = min(component)
+                node = self.nodes[key]
+                prereq_key = min(prereq for prereq in node.prerequisites if prereq in component)
+                log.warning("Cleanup dependency cycle detected at %s (dropping its dependency "
+                            "on %s)", key, prereq_key)
+                node.prerequisites.discard(prereq_key)
+                self.nodes[prereq_key].dependents.discard(key)
+
+    def _blocked_nodes(self):
+        """ Returns the keys of the nodes which would never become ready (Kahn's algorithm). """
+        pending = {key: len(node.prerequisites) for key, node in self.nodes.items()}
+        ready = [key for key, count in pending.items() if not count]
+        while ready:
+            key = ready.pop()
+            for dep_key in self.nodes[key].dependents:
+                pending[dep_key] -= 1
+                if not pending[dep_key]:
+                    ready.append(dep_key)
+        return {key for key, count in pending.items() if count}
+
+    def _strong_components(self, keys):
+        """ Returns the strongly connected components of more than one node (i.e., the cycle
+        members) of the given nodes' subgraph (Tarjan's algorithm, iterative). """
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        components = []
+        for root in keys:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.nodes[root].dependents))]
+            while work:
+                key, edges = work[-1]
+                for dep_key in edges:
+                    if dep_key not in keys:
+                        continue
+                    if dep_key not in index:
+                        index[dep_key] = low[dep_key] = len(index)
+                        stack.append(dep_key)
+                        on_stack.add(dep_key)
+                        work.append((dep_key, iter(self.nodes[dep_key].dependents)))
+                        break
+                    if dep_key in on_stack:
+                        low[key] = min(low[key], index[dep_key])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[key])
+                    if low[key] == index[key]:
+                        component = set()
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.add(member)
+                            if member == key:
+                                break
+                        if len(component) > 1:
+                            components.append(component)
+        return components
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+class ParallelCleanup():
+    """ Deletes the resources of a graph using the thread pool: each resource is scheduled as
+    soon as all of its prerequisites were processed, so independent branches are deleted
+    concurrently.
+
+    If a `deadline` (timestamp) is given, the cleanup converges: the instances are terminated
+    in batch, the instances / NAT gateways are polled (with bounded backoff) until they are
+    actually gone before their dependents are scheduled, and the deletions failing because of
+    busy dependencies are retried until the deadline passes. """
+
+    # the states of the resources which are deleted asynchronously by AWS
+    GONE_STATES = {
+        "Instances": ("terminated",),
+        "NatGateways": ("deleted",),
+    }
+
+    def __init__(self, thread_pool, resource_map, dryrun=False, deadline=None,
+                 backoff=(2, 15), on_progress=None):
+        self._thread_pool = thread_pool
+        self._on_progress = on_progress  # called with (resources, errors) as they are processed
+        self._graph = CleanupGraph(resource_map)
+        self._dryrun = dryrun
+        self._deadline = deadline
+        self._backoff = backoff  # (initial, maximum) delay, in seconds
+        self._lock = Lock()
+        self._pending = {}
+        self._attempts = {}
+        self._remaining = 0
+        self._errors = []
+        self.future = Future()
+
+    @property
+    def converge(self):
+        return self._deadline is not None and not self._dryrun
+
+    def start(self):
+        """ Starts the cleanup and returns a future for the list of errors encountered. """
+        nodes = self._graph.nodes
+        self._pending = {key: len(node.prerequisites) for key, node in nodes.items()}
+        self._remaining = len(nodes)
+        self.future.set_running_or_notify_cancel()
+        if not nodes:
+            self.future.set_result([])
+            return self.future
+        self._schedule_all([nodes[key] for key, count in self._pending.items() if not count])
+        return self.future
+
+    def _schedule_all(self, nodes):
+        instances = [node for node in nodes if node.resource.res_type == "Instances"]
+        if instances and self.converge:
+            self._schedule_batch(instances)
+            nodes = [node for node in nodes if node.resource.res_type != "Instances"]
+        for node in nodes:
+            self._schedule(node)
+
+    def _schedule(self, node):
+        task = DeleteResourceTask(resource=node.resource, dryrun=self._dryrun)
+        task_future = self._thread_pool.queue_task(task)
+        task_future.add_done_callback(lambda future: self._delete_done([node], future))
+
+    def _schedule_batch(self, nodes):
+        task = TerminateInstancesTask(resources=[node.resource for node in nodes],
+                                      dryrun=self._dryrun)
+        task_future = self._thread_pool.queue_task(task)
+        task_future.add_done_callback(lambda future: self._delete_done(nodes, future))
+
+    def _schedule_later(self, delay, func, *args):
+        self._thread_pool.call_later(delay, func, *args)
+
+    def _next_delay(self, attempt):
+        """ Returns the backoff delay of an attempt (or None if the deadline would be
+        exceeded). """
+        delay = min(self._backoff[0] * (2 ** attempt), self._backoff[1])
+        if time.time() + delay > self._deadline:
+            return None
+        return delay
+
+    def _fail(self, exc):
+        """ Fails the whole cleanup (e.g., on an unexpected error in a callback). """
+        log.error("Cleanup failed", exc_info=exc)
+        with self._lock:
+            if self.future.done():
+                return
+            self.future.set_exception(exc)
+
+    @staticmethod
+    def _aborted_error():
+        return RuntimeError("the cleanup was aborted (the thread pool was shut down)")
+
+    def _delete_done(self, nodes, task_future):
+        """ Called (from the worker threads) when a deletion task finished. """
+        try:
+            self._process_deletion(nodes, task_future)
+        except Exception as exc:
+            self._fail(exc)
+
+    def _process_deletion(self, nodes, task_future):
+        if task_future.cancelled():
+            # note: the pool was shut down, don't reschedule anything
+            self._nodes_done(nodes, [self._aborted_error()])
+            return
+        try:
+            result = task_future.result()
+        except Exception as exc:
+            result = [exc]
+        if isinstance(result, Mapping):
+            # the errors of each instance of a batch
+            node_errors = [(node, result.get(node.resource.id, [])) for node in nodes]
+        else:
+            node_errors = [(node, result) for node in nodes]
+        if not self.converge:
+            self._nodes_done(nodes, self._merge_errors(node_errors))
+            return
+
+        retry = [(node, errors) for node, errors in node_errors
+                 if errors and all(self._is_retryable(err) for err in errors)]
+        if retry:
+            with self._lock:
+                attempt = self._attempts.get(retry[0][0].key, 0)
+                self._attempts[retry[0][0].key] = attempt + 1
+            delay = self._next_delay(attempt)
+            if delay is not None:
+                retry_nodes = [node for node, _ in retry]
+                log.debug("Retrying the deletion of %s in %ss", retry_nodes[0].key, delay)
+                if retry_nodes[0].resource.res_type == "Instances":
+                    self._schedule_later(delay, self._schedule_batch, retry_nodes)
+                else:
+                    self._schedule_later(delay, self._schedule, retry_nodes[0])
+                node_errors = [(node, errors) for node, errors in node_errors
+                               if node not in retry_nodes]
+        gone = [node for node, errors in node_errors if not errors]
+        res_type = nodes[0].resource.res_type
+        if gone and res_type in self.GONE_STATES:
+            self._poll_states(res_type, {node.key[1]: node for node in gone})
+        elif gone:
+            self._nodes_done(gone, [])
+        # report the errors of each failed node on its own
+        for node, errors in node_errors:
+            if errors:
+                self._nodes_done([node], errors)
+
+    @staticmethod
+    def _merge_errors(node_errors):
+        """ Returns the distinct errors of a list of (node, errors). """
+        merged = []
+        for _, errors in node_errors:
+            merged.extend(err for err in errors if not any(err is known for known in merged))
+        return merged
+
+    def _poll_states(self, res_type, nodes, attempt=0):
+        """ Waits for the asynchronously deleted resources ({id: node}) to be gone. """
+        task = RetrieveResourceStates(res_type=res_type, res_ids=list(nodes))
+        task_future = self._thread_pool.queue_task(task)
+        task_future.add_done_callback(
+            lambda future: self._poll_done(res_type, nodes, attempt, future))
+
+    def _poll_done(self, res_type, nodes, attempt, task_future):
+        try:
+            self._process_poll(res_type, nodes, attempt, task_future)
+        except Exception as exc:
+            self._fail(exc)
+
+    def _process_poll(self, res_type, nodes, attempt, task_future):
+        if task_future.cancelled():
+            # note: the pool was shut down, stop polling
+            self._nodes_done(list(nodes.values()), [self._aborted_error()])
+            return
+        try:
+            states = task_future.result()
+        except Exception as exc:
+            log.warning("Polling the %s states failed: %s", res_type, str(exc))
+            states = {res_id: None for res_id in nodes}
+        waiting = {}
+        gone = []
+        for res_id, node in nodes.items():
+            if res_id in states and states[res_id] not in self.GONE_STATES[res_type]:
+                waiting[res_id] = node
+            else:
+                gone.append(node)
+        if gone:
+            self._nodes_done(gone, [])
+        if not waiting:
+            return
+        delay = self._next_delay(attempt)
+        if delay is None:
+            self._nodes_done(list(waiting.values()), [
+                TimeoutError("timed out waiting for %s to be deleted: %s" %
+                             (res_type, ", ".join(waiting)))])
+            return
+        self._schedule_later(delay, self._poll_states, res_type, waiting, attempt + 1)
+
+    def _is_retryable(self, error):
+        return classify_error(error) is not None
+
+    def _nodes_done(self, nodes, errors):
+        """ Marks the nodes as processed and schedules their ready dependents. """
+        try:
+            self._process_nodes(nodes, errors)
+        except Exception as exc:
+            self._fail(exc)
+
+    def _process_nodes(self, nodes, errors):
+        if self._on_progress:
+            self._on_progress([node.resource for node in nodes], errors)
+        ready = []
+        with self._lock:
+            self._errors.extend(errors)
+            for node in nodes:
+                self._remaining -= 1
+                for dep_key in node.dependents:
+                    self._pending[dep_key] -= 1
+                    if not self._pending[dep_key]:
+                        ready.append(self._graph.nodes[dep_key])
+            finished = not self._remaining
+        self._schedule_all(ready)
+        if finished:
+            with self._lock:
+                if not self.future.done():
+                    self.future.set_result(self._errors)
@@ -0,0 +1,152 @@
+""" Process-wide adaptive rate limiting of the AWS API calls. """
+
+import time
+import logging
+from threading import Lock
+from collections.abc import Mapping
+
+from ..metrics import METRICS
+from .retry import THROTTLING_CODES
+
+log = logging.getLogger(__name__)
+
+API_CALLS = METRICS.counter("aws_api_calls_total", "Number of AWS API calls sent",
+                            labels=("operation_class",))
+API_THROTTLED = METRICS.counter("aws_api_throttled_total", "Number of throttled AWS API calls",
+                                labels=("operation_class",))
+
+
+# default limits: {"service.class": {"rate": calls / second, "burst": bucket size}}
+DEFAULT_RATE_LIMITS = {
+    "ec2.read": {"rate": 20, "burst": 50},
+    "ec2.mutate": {"rate": 5, "burst": 20},
+    "iam.read": {"rate": 10, "burst": 20},
+    "iam.mutate": {"rate": 5, "burst": 10},
+    "default": {"rate": 10, "burst": 20},
+}
+READ_PREFIXES = ("Describe", "List", "Get")
+
+
+def operation_class(service, operation):
+    """ Returns the rate limiting key of an API operation (e.g., "ec2.read"). """
+    op_class = "read" if operation.startswith(READ_PREFIXES) else "mutate"
+    return service + "." + op_class
+
+
+class AdaptiveTokenBucket():
+    """ Token bucket whose refill rate is halved on each throttling response (down to
+    `min_factor` of the configured rate) and recovers linearly (in `recovery` seconds). """
+
+    def __init__(self, rate, burst, min_factor=0.1, recovery=30):
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate * min_factor
+        self.burst = float(burst)
+        self.recovery = recovery
+        self.rate = self.max_rate
+        self.throttled = 0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate,
+                            self.rate + elapsed * self.max_rate / self.recovery)
+
+    def acquire(self):
+        """ Takes a token (blocks until one is available). """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_throttle(self):
+        """ Shrinks the rate after a throttling response. """
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+            self.throttled += 1
+
+
+class RateLimiters():
+    """ The registry of rate limiters (one per service & operation class). """
+
+    def __init__(self):
+        self._limits = dict(DEFAULT_RATE_LIMITS)
+        self._buckets = {}
+        self._lock = Lock()
+
+    def configure(self, limits):
+        """ Updates the configured limits (the existing buckets are reset). Each key's options
+        are merged with its defaults (e.g., only the `rate` may be given). Raises `ValueError`
+        for invalid limits. """
+        if not limits:
+            return
+        merged = {}
+        for key, value in limits.items():
+            if not isinstance(value, Mapping):
+                raise ValueError("Invalid rate limit %s: %r" % (key, value))
+            merged[key] = dict(DEFAULT_RATE_LIMITS.get(key, DEFAULT_RATE_LIMITS["default"]))
+            merged[key].update(value)
+            try:
+                bucket = AdaptiveTokenBucket(**merged[key])
+            except (TypeError, ValueError) as exc:
+                raise ValueError("Invalid rate limit %s: %s" % (key, str(exc)))
+            if bucket.max_rate <= 0 or bucket.burst < 1:
+                raise ValueError("Invalid rate limit %s: the rate / burst are too low" % key)
+        with self._lock:
+            self._limits.update(merged)
+            self._buckets = {}
+
+    def get(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key, None)
+            if bucket is None:
+                limits = self._limits.get(key, self._limits["default"])
+                bucket = AdaptiveTokenBucket(**limits)
+                self._buckets[key] = bucket
+            return bucket
+
+    def install(self, client):
+        """ Registers the rate limiting handlers with a botocore client. """
+        events = client.meta.events
+        events.register("before-send", self._before_send)
+        events.register("needs-retry", self._needs_retry)
+
+    def _before_send(self, event_name, **kwargs):
+        # event name: before-send.<service>.<Operation>
+        _, service, operation = event_name.split(".", 2)
+        key = operation_class(service, operation)
+        self.get(key).acquire()
+        API_CALLS.inc(operation_class=key)
+
+    def _needs_retry(self, event_name, response=None, **kwargs):
+        # event name: needs-retry.<service>.<Operation>
+        if not response:
+            return
+        code = response[1].get("Error", {}).get("Code", "")
+        if code in THROTTLING_CODES:
+            _, service, operation = event_name.split(".", 2)
+            key = operation_class(service, operation)
+            log.warning("AWS API throttled (%s), slowing down", key)
+            API_THROTTLED.inc(operation_class=key)
+            self.get(key).on_throttle()
+
+    def get_stats(self):
+        """ Returns the current rates and throttling counts. """
+        with self._lock:
+            return {key: {"rate": round(bucket.rate, 2), "throttled": bucket.throttled}
+                    for key, bucket in self._buckets.items()}
+
+
+# the process-wide rate limiters
+RATE_LIMITERS = RateLimiters()
@@ -0,0 +1,141 @@
+""" AWS tasks retry subsystem: error classification, backoff policy and delayed queue. """
+
+import time
+import heapq
+import random
+import logging
+from threading import Thread, Condition
+from concurrent.futures import Future
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+log = logging.getLogger(__name__)
+
+
+# error kinds
+ERROR_THROTTLING = "throttling"
+ERROR_DEPENDENCY = "dependency"
+ERROR_TRANSIENT = "transient"
+
+THROTTLING_CODES = {
+    "Throttling", "ThrottlingException", "ThrottledException", "RequestThrottledException",
+    "RequestThrottled", "RequestLimitExceeded", "TooManyRequestsException", "SlowDown",
+    "PriorRequestNotComplete",
+}
+DEPENDENCY_CODES = {
+    "DependencyViolation", "InvalidIPAddress.InUse", "InvalidNetworkInterface.InUse",
+    "ResourceInUse", "IncorrectState",
+}
+TRANSIENT_CODES = {
+    "InternalError", "InternalFailure", "ServiceUnavailable", "Unavailable",
+    "RequestTimeout", "RequestTimeoutException", "EntityTemporarilyUnmodifiable",
+    "ConcurrentModification",
+}
+
+
+class RetryableError(Exception):
+    """ Raised by a task whose (eventually consistent) result is not visible yet. """
+    kind = ERROR_TRANSIENT
+
+
+def classify_error(exc):
+    """ Returns the kind of a retryable AWS error (None if the error is not retryable). """
+    if isinstance(exc, RetryableError):
+        return exc.kind
+    if isinstance(exc, ClientError):
+        code = exc.response.get("Error", {}).get("Code", "")
+        if code in THROTTLING_CODES:
+            return ERROR_THROTTLING
+        if code in DEPENDENCY_CODES:
+            return ERROR_DEPENDENCY
+        status = exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        if code in TRANSIENT_CODES or status >= 500:
+            return ERROR_TRANSIENT
+        return None
+    if isinstance(exc, (ConnectionError, HTTPClientError)):
+        return ERROR_TRANSIENT
+    return None
+
+
+class RetryPolicy():
+    """ Exponential backoff with (full) jitter. The throttling errors back off slower. """
+
+    def __init__(self, base_delay=0.5, max_delay=20, throttling_factor=4):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttling_factor = throttling_factor
+
+    def get_delay(self, attempt, kind=None):
+        """ Returns the delay before the next try, after the given (1-based) attempt failed. """
+        base = self.base_delay
+        if kind == ERROR_THROTTLING:
+            base *= self.throttling_factor
+        return random.uniform(0, min(self.max_delay, base * (2 ** (attempt - 1))))
+
+
+class AwsTaskFuture(Future):
+    """ Future for a task's result, also recording the number of attempts and the final
+    outcome ("succeeded", "failed" or "exhausted" - when the retries were exhausted). """
+
+    def __init__(self):
+        super().__init__()
+        self.attempts = 0
+        self.outcome = None
+
+
+class DelayedQueue(Thread):
+    """ Calls functions after a delay from a single background thread (the functions must be
+    quick, e.g., re-queueing a task). """
+
+    def __init__(self):
+        super().__init__(name="DelayedQueue", daemon=True)
+        self._heap = []
+        self._seq = 0
+        self._cond = Condition()
+        self._finished = False
+        self.start()
+
+    def call_later(self, delay, func, *args):
+        """ Schedules the function to be called after `delay` seconds (right away if the
+        queue was shut down). """
+        with self._cond:
+            if not self._finished:
+                self._seq += 1
+                heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, func, args))
+                self._cond.notify()
+                return
+        func(*args)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def run(self):
+        """ The thread's loop """
+        while True:
+            with self._cond:
+                while not self._finished:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                if self._finished:
+                    return
+                _, _, func, args = heapq.heappop(self._heap)
+            try:
+                func(*args)
+            except Exception:
+                log.exception("Delayed call failed")
+
+    def shutdown(self):
+        """ Stops the thread (the pending calls are executed right away). """
+        with self._cond:
+            self._finished = True
+            pending = sorted(self._heap)
+            self._heap = []
+            self._cond.notify()
+        for _, _, func, args in pending:
+            try:
+                func(*args)
+            except Exception:
+                log.exception("Delayed call failed")
@@ -5,49 +5,103 @@ import string
 import random
 import time
 import re
-from concurrent.futures import Future
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
 from botocore.exceptions import ClientError
-from ..model.aws import normalize_resources
+from ..model.aws import RESOURCE_TYPES
 from .utils import AWSSafeExec
+from .retry import AwsTaskFuture, RetryableError, classify_error
 
 log = logging.getLogger(__name__)
 
 
+# task priority classes (lower is served first)
+PRIORITY_INTERACTIVE = 0  # student requests
+PRIORITY_ADMIN = 1  # admin reads / actions
+PRIORITY_BULK = 2  # bulk maintenance (resets, cleanups)
+
+# the executor shared by the concurrent describe calls (created on first use)
+_FETCH_EXECUTOR = None
+_FETCH_EXECUTOR_LOCK = threading.Lock()
+
+
+def _fetch_executor(max_workers):
+    """ Returns the shared describe executor (`max_workers` only sizes it when created). """
+    global _FETCH_EXECUTOR
+    with _FETCH_EXECUTOR_LOCK:
+        if _FETCH_EXECUTOR is None:
+            _FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=max_workers,
+                                                 thread_name_prefix="ec2-fetch")
+        return _FETCH_EXECUTOR
+
+
 class AwsTask():
-    """ Base class for AWS tasks """
+    """ Base class for AWS tasks (`retry`: the number of times to retry the task if it fails
+    with a retryable error). """
+
+    priority = PRIORITY_ADMIN
+
     def __init__(self, **kwargs):
         self.retry = kwargs.pop("retry", None)
-        self.future = Future()
+        if "priority" in kwargs:
+            self.priority = kwargs.pop("priority")
+        self.future = AwsTaskFuture()
 
     def execute(self, aws):
         raise NotImplementedError()
 
 
 class RetrieveStudentUsers(AwsTask):
-    """ Retrieves all student users from AWS IAM. """
+    """ Retrieves all student users from AWS IAM (following every result page).
+
+    The users are narrowed down server-side using the IAM `path_prefix` (if given) and then
+    matched against the (compiled) `pattern`. If `on_page` is given, it is called with the
+    matching users of each page as soon as it arrives. """
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.pattern = kwargs.pop("pattern")
+        self.pattern = re.compile(kwargs.pop("pattern"))
+        self.path_prefix = kwargs.pop("path_prefix", None)
+        self.on_page = kwargs.pop("on_page", None)
 
     def execute(self, aws):
         iam = aws.client("iam")
-        users = iam.list_users()["Users"]
         filtered_users = []
+        for page in self.iter_pages(iam):
+            if self.on_page:
+                self.on_page(page)
+            filtered_users.extend(page)
+        return filtered_users
+
+    def iter_pages(self, iam):
+        """ Generates the list of matching users for each result page. """
+        args = {}
+        if self.path_prefix:
+            args["PathPrefix"] = self.path_prefix
+        for page in iam.get_paginator("list_users").paginate(**args):
+            yield list(self.convert_users(self.filter_users(page.get("Users", []))))
+
+    def filter_users(self, users):
+        for user in users:
+            if self.pattern.match(user["UserName"]):
+                yield user
+
+    @staticmethod
+    def convert_users(users):
         for user in users:
-            username = user["UserName"]
-            if not re.match(self.pattern, username):
-                continue
             last_used = user.get("PasswordLastUsed", None)
-            filtered_users.append({
-                "username": username,
+            yield {
+                "username": user["UserName"],
                 "last_used": last_used.timestamp() if last_used else None
-            })
-        return filtered_users
+            }
 
 
 class ChangeUserPassword(AwsTask):
     """ Changes an user's password """
+
+    priority = PRIORITY_INTERACTIVE
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.username = kwargs.pop("username")
@@ -74,8 +128,35 @@ class ChangeUserPassword(AwsTask):
         return True
 
 
+class ConfirmLoginProfile(AwsTask):
+    """ Checks that an user's login profile is visible (IAM is eventually consistent). Raises
+    a retryable error while it is not, so queue it with enough retries (and a delay) instead
+    of waiting in the worker. """
+
+    priority = PRIORITY_BULK
+    ATTEMPTS = 10
+    DELAY = 1  # seconds (before the first check)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.username = kwargs.pop("username")
+
+    def execute(self, aws):
+        iam = aws.client("iam")
+        try:
+            iam.get_login_profile(UserName=self.username)
+        except ClientError as ex:
+            if ex.response['Error']['Code'] == 'NoSuchEntity':
+                raise RetryableError("login profile of %s not visible yet" % self.username)
+            raise ex
+        return True
+
+
 class RemoveUserProfile(AwsTask):
     """ Removes an user's login profile, preventing further authentication """
+
+    priority = PRIORITY_BULK
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.username = kwargs.pop("username")
@@ -93,59 +174,346 @@ class RemoveUserProfile(AwsTask):
 
 
 class RetrieveEC2Resources(AwsTask):
-    """ Retrieves the collection of all relevant resources. """
+    """ Retrieves the collection of all relevant resources.
+
+    The per-type describe calls are executed concurrently (unless `concurrent=False`) on
+    an executor shared by all the runs and every paginator page is followed. If a `collection` is given, the pages are streamed
+    into it as they arrive (and the collection is returned), otherwise the raw resources
+    are returned as dict of lists. """
+
+    # {"ResourceType": "describe operation"}
+    FETCH_TYPES = {
+        "Instances": "describe_instances",
+        "KeyPairs": "describe_key_pairs",
+        "NetworkInterfaces": "describe_network_interfaces",
+        "Vpcs": "describe_vpcs",
+        "Addresses": "describe_addresses",
+        "InternetGateways": "describe_internet_gateways",
+        "NatGateways": "describe_nat_gateways",
+        "Subnets": "describe_subnets",
+        "RouteTables": "describe_route_tables",
+        "SecurityGroups": "describe_security_groups",
+    }
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.collection = kwargs.pop("collection", None)
+        self.concurrent = kwargs.pop("concurrent", True)
+        self.max_workers = kwargs.pop("max_workers", None) or len(self.FETCH_TYPES)
+        self.page_size = kwargs.pop("page_size", None)
 
     def execute(self, aws):
         ec2 = aws.client("ec2")
-        FETCH_TYPES = {
-            "Instances": (self.describe_instances, (ec2,)),
-            "KeyPairs": ec2.describe_key_pairs,
-            "NetworkInterfaces": ec2.describe_network_interfaces,
-            "Vpcs": ec2.describe_vpcs,
-            "Addresses": ec2.describe_addresses,
-            "InternetGateways": ec2.describe_internet_gateways,
-            "NatGateways": (self.describe_nat_gateways, (ec2,)),
-            "Subnets": ec2.describe_subnets,
-            "RouteTables": ec2.describe_route_tables,
-            "SecurityGroups": ec2.describe_security_groups,
-        }
-        resources = {}
-        for res_type, func in FETCH_TYPES.items():
-            if isinstance(func, tuple):
-                resources[res_type] = func[0](*func[1])
-            else:
-                result = func()
-                if result.get(res_type, None):
-                    resources[res_type] = result[res_type]
+        resources = {res_type: [] for res_type in self.FETCH_TYPES}
+
+        def fetch(res_type):
+            for page in self.iter_pages(ec2, res_type):
+                if self.collection is not None:
+                    self.collection.add_resources(res_type, page)
                 else:
-                    resources[res_type] = []
+                    resources[res_type].extend(page)
+
+        if self.concurrent:
+            # note: botocore clients are thread safe (sessions are not)
+            executor = _fetch_executor(self.max_workers)
+            futures = [executor.submit(fetch, res_type) for res_type in self.FETCH_TYPES]
+            for future in futures:
+                future.result()  # propagate the exceptions
+        else:
+            for res_type in self.FETCH_TYPES:
+                fetch(res_type)
 
+        if self.collection is not None:
+            return self.collection
         return resources
 
-    def describe_instances(self, ec2):
-        raw_instances = ec2.describe_instances()
+    def iter_pages(self, ec2, res_type):
+        """ Generates the (filtered) resource lists of every result page of a type. """
+        operation = self.FETCH_TYPES[res_type]
+        if ec2.can_paginate(operation):
+            pagination = {}
+            if self.page_size:
+                pagination["PageSize"] = self.page_size
+            pages = ec2.get_paginator(operation).paginate(PaginationConfig=pagination)
+        else:
+            pages = [getattr(ec2, operation)()]
+        for page in pages:
+            if res_type == "Instances":
+                yield self.filter_instances(page)
+            elif res_type == "NatGateways":
+                yield self.filter_nat_gateways(page)
+            else:
+                yield page.get(res_type, None) or []
+
+    @staticmethod
+    def filter_instances(page):
         # a reservation may contain multiple instances
         instances = []
-        for reservation in raw_instances["Reservations"]:
+        for reservation in page.get("Reservations", []):
             for inst in reservation.get("Instances", []):
                 if inst["State"]["Name"] != "terminated":
                     instances.append(inst)
         return instances
 
-    def describe_nat_gateways(self, ec2):
-        raw_nat = ec2.describe_nat_gateways()
+    @staticmethod
+    def filter_nat_gateways(page):
         # exclude deleted gateways
         nat_gws = []
-        for nat in raw_nat["NatGateways"]:
+        for nat in page.get("NatGateways", []):
             if nat["State"] != "deleted":
                 nat_gws.append(nat)
         return nat_gws
 
+
+class RetrieveEC2ResourceRaw(AwsTask):
+    """ Retrieves the full (raw) description of a single resource (for debugging). """
+
+    # {"ResourceType": "IDs argument of the describe operation"}
+    ID_ARGS = {
+        "Instances": "InstanceIds",
+        "KeyPairs": "KeyNames",
+        "NetworkInterfaces": "NetworkInterfaceIds",
+        "Vpcs": "VpcIds",
+        "Addresses": "AllocationIds",
+        "InternetGateways": "InternetGatewayIds",
+        "NatGateways": "NatGatewayIds",
+        "Subnets": "SubnetIds",
+        "RouteTables": "RouteTableIds",
+        "SecurityGroups": "GroupIds",
+    }
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.res_type = kwargs.pop("res_type")
+        self.res_id = kwargs.pop("res_id")
+
+    def execute(self, aws):
+        ec2 = aws.client("ec2")
+        operation = RetrieveEC2Resources.FETCH_TYPES[self.res_type]
+        args = {self.ID_ARGS[self.res_type]: [self.res_id]}
+        result = getattr(ec2, operation)(**args)
+        if self.res_type == "Instances":
+            items = [inst for reservation in result.get("Reservations", [])
+                     for inst in reservation.get("Instances", [])]
+        else:
+            items = result.get(self.res_type, [])
+        return items[0] if items else None
+
+
+def delete_instance(ec2, resource, safexc, dryrun=False):
+    with safexc:
+        ec2.terminate_instances(InstanceIds=[resource.id], DryRun=dryrun)
+
+
+def delete_key_pair(ec2, resource, safexc, dryrun=False):
+    with safexc:
+        ec2.delete_key_pair(KeyName=resource.id, DryRun=dryrun)
+
+
+def delete_network_interface(ec2, resource, safexc, dryrun=False):
+    with safexc:
+        ec2.delete_network_interface(NetworkInterfaceId=resource.id, DryRun=dryrun)
+
+
+def delete_vpc(ec2, resource, safexc, dryrun=False):
+    with safexc:
+        ec2.delete_vpc(VpcId=resource.id, DryRun=dryrun)
+
+
+def delete_address(ec2, resource, safexc, dryrun=False):
+    with safexc:
+        ec2.release_address(AllocationId=resource.id, DryRun=dryrun)
+
+
+def delete_inet_gateway(ec2, resource, safexc, dryrun=False):
+    for vpc_id in resource.attachments:
+        with safexc:
+            try:
+                ec2.detach_internet_gateway(
+                    InternetGatewayId=resource.id, VpcId=vpc_id, DryRun=dryrun)
+            except ClientError as ex:
+                if ex.response['Error']['Code'] == 'Gateway.NotAttached':
+                    pass  # it's okay, detached by a previous attempt
+                else:
+                    raise ex
+    with safexc:
+        ec2.delete_internet_gateway(InternetGatewayId=resource.id, DryRun=dryrun)
+
+
+def delete_nat_gateway(ec2, resource, safexc, dryrun=False):
+    with safexc:
+        if not dryrun:
+            ec2.delete_nat_gateway(NatGatewayId=resource.id)
+
+
+def delete_subnet(ec2, resource, safexc, dryrun=False):
+    with safexc:
+        ec2.delete_subnet(SubnetId=resource.id, DryRun=dryrun)
+
+
+def delete_route_table(ec2, resource, safexc, dryrun=False):
+    is_main = False
+    for assoc_id, assoc_main in resource.associations:
+        if assoc_main:
+            is_main = True
+            continue
+        with safexc:
+            try:
+                ec2.disassociate_route_table(AssociationId=assoc_id, DryRun=dryrun)
+            except ClientError as ex:
+                if ex.response['Error']['Code'] == 'InvalidAssociationID.NotFound':
+                    pass  # it's okay, disassociated by a previous attempt
+                else:
+                    raise ex
+    if is_main:
+        return  # main route tables are deleted with their VPC
+    with safexc:
+        ec2.delete_route_table(RouteTableId=resource.id, DryRun=dryrun)
+
+
+def delete_security_group(ec2, resource, safexc, dryrun=False):
+    if resource.group_name == "default":
+        return  # default group cannot be deleted
+    with safexc:
+        ec2.delete_security_group(GroupId=resource.id, DryRun=dryrun)
+
+
+DELETE_FUNCS = {
+    "Instances": delete_instance,
+    "NetworkInterfaces": delete_network_interface,
+    "KeyPairs": delete_key_pair,
+    "Vpcs": delete_vpc,
+    "Addresses": delete_address,
+    "InternetGateways": delete_inet_gateway,
+    "NatGateways": delete_nat_gateway,
+    "Subnets": delete_subnet,
+    "RouteTables": delete_route_table,
+    "SecurityGroups": delete_security_group,
+}
+
+
+class DeleteResourceTask(AwsTask):
+    """ Deletes a single AWS resource (returns the list of errors). """
+
+    priority = PRIORITY_BULK
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.resource = kwargs.pop("resource")
+        self.dryrun = kwargs.pop("dryrun", False)
+
+    def execute(self, aws):
+        ec2 = aws.client("ec2")
+        resource = self.resource
+        log.info("Deleting %s: %s", resource.res_type, resource.id)
+        safexc = AWSSafeExec("delete_" + resource.res_type, log=log)
+        DELETE_FUNCS[resource.res_type](ec2, resource, safexc, dryrun=self.dryrun)
+        return safexc.errors
+
+
+class TerminateInstancesTask(AwsTask):
+    """ Terminates a batch of instances using a single API call (per `BATCH_SIZE` instances).
+    A batch failing with a non-retryable error (e.g., a single instance with termination
+    protection) is terminated one by one instead. Returns the errors of each failed instance:
+    `{id: [errors]}`. """
+
+    priority = PRIORITY_BULK
+
+    BATCH_SIZE = 500
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.resources = kwargs.pop("resources")
+        self.dryrun = kwargs.pop("dryrun", False)
+
+    def execute(self, aws):
+        ec2 = aws.client("ec2")
+        ids = [resource.id for resource in self.resources]
+        log.info("Terminating instances: %s", ids)
+        errors = {}
+        for idx in range(0, len(ids), self.BATCH_SIZE):
+            batch = ids[idx:idx + self.BATCH_SIZE]
+            try:
+                ec2.terminate_instances(InstanceIds=batch, DryRun=self.dryrun)
+            except Exception as ex:
+                if len(batch) > 1 and isinstance(ex, ClientError) and not classify_error(ex):
+                    log.warning("terminate_instances: %s (terminating one by one)", str(ex))
+                    for res_id in batch:
+                        self.terminate_one(ec2, res_id, errors)
+                else:
+                    log.warning("terminate_instances: %s", str(ex))
+                    for res_id in batch:
+                        errors[res_id] = [ex]
+        return errors
+
+    def terminate_one(self, ec2, res_id, errors):
+        try:
+            ec2.terminate_instances(InstanceIds=[res_id], DryRun=self.dryrun)
+        except ClientError as ex:
+            if ex.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+                return  # it's okay, already gone
+            log.warning("terminate_instances(%s): %s", res_id, str(ex))
+            errors[res_id] = [ex]
+        except Exception as ex:
+            log.warning("terminate_instances(%s): %s", res_id, str(ex))
+            errors[res_id] = [ex]
+
+
+class RetrieveResourceStates(AwsTask):
+    """ Retrieves the current states of a batch of resources of the same type: {id: state}.
+    The resources which no longer exist are missing from the result. """
+
+    priority = PRIORITY_BULK
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.res_type = kwargs.pop("res_type")
+        self.res_ids = kwargs.pop("res_ids")
+
+    def execute(self, aws):
+        ec2 = aws.client("ec2")
+        states = {}
+        try:
+            self.describe_states(ec2, self.res_ids, states)
+        except ClientError as ex:
+            if not ex.response['Error']['Code'].endswith("NotFound"):
+                raise ex
+            # (at least) one of the resources is gone, describe them one by one
+            for res_id in self.res_ids:
+                try:
+                    self.describe_states(ec2, [res_id], states)
+                except ClientError as ex:
+                    if not ex.response['Error']['Code'].endswith("NotFound"):
+                        raise ex
+        return states
+
+    def describe_states(self, ec2, res_ids, states):
+        operation = RetrieveEC2Resources.FETCH_TYPES[self.res_type]
+        args = {RetrieveEC2ResourceRaw.ID_ARGS[self.res_type]: list(res_ids)}
+        pages = ec2.get_paginator(operation).paginate(**args)
+        id_key = RESOURCE_TYPES[self.res_type][0]
+        for page in pages:
+            if self.res_type == "Instances":
+                items = [inst for reservation in page.get("Reservations", [])
+                         for inst in reservation.get("Instances", [])]
+            else:
+                items = page.get(self.res_type, [])
+            for item in items:
+                state = item.get("State", None)
+                if isinstance(state, Mapping):
+                    state = state.get("Name", None)
+                states[item[id_key]] = state
+
+
 class CleanupUserResourcesTask(AwsTask):
-    """ Deletes AWS user resources. """
+    """ Deletes AWS user resources (serially, see `lib.aws.cleanup` for the parallel
+    engine). """
+
+    priority = PRIORITY_BULK
+
+    ORDER = ["Instances", "KeyPairs", "RouteTables", "NetworkInterfaces", "SecurityGroups",
+             "Subnets", "Addresses", "InternetGateways", "NatGateways", "Vpcs", ]
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.resource_map = kwargs.pop("resource_map")
@@ -153,120 +521,14 @@ class CleanupUserResourcesTask(AwsTask):
 
     def execute(self, aws):
         ec2 = aws.client("ec2")
-
-        def delete_instances(resources):
-            ids = [resource.id for resource in resources]
-            safexc = AWSSafeExec("delete_instances", log=log)
-            for inst_id in ids:
-                with safexc:
-                    ec2.terminate_instances(InstanceIds=[inst_id], DryRun=self.dryrun)
-            return safexc
-
-        def delete_key_pairs(resources):
-            safexc = AWSSafeExec("delete_key_pairs", log=log)
-            for resource in resources:
-                with safexc:
-                    ec2.delete_key_pair(KeyName=resource.id, DryRun=self.dryrun)
-            return safexc
-
-        def delete_network_interfaces(resources):
-            safexc = AWSSafeExec("delete_network_interfaces", log=log)
-            for resource in resources:
-                with safexc:
-                    ec2.delete_network_interface(NetworkInterfaceId=resource.id, DryRun=self.dryrun)
-            return safexc
-
-        def delete_vpcs(resources):
-            safexc = AWSSafeExec("delete_vpcs", log=log)
-            for resource in resources:
-                with safexc:
-                    ec2.delete_vpc(VpcId=resource.id, DryRun=self.dryrun)
-            return safexc
-
-        def delete_addresses(resources):
-            safexc = AWSSafeExec("delete_addresses", log=log)
-            for resource in resources:
-                with safexc:
-                    ec2.release_address(AllocationId=resource.id, DryRun=self.dryrun)
-            return safexc
-
-        def delete_inet_gateways(resources):
-            safexc = AWSSafeExec("delete_inet_gateways", log=log)
-            for resource in resources:
-                for attach in resource.raw.get("Attachments", []):
-                    with safexc:
-                        ec2.detach_internet_gateway(
-                            InternetGatewayId=resource.id, VpcId=attach["VpcId"],
-                            DryRun=self.dryrun)
-                with safexc:
-                    ec2.delete_internet_gateway(InternetGatewayId=resource.id, DryRun=self.dryrun)
-            return safexc
-
-        def delete_nat_gateways(resources):
-            safexc = AWSSafeExec("delete_nat_gateways", log=log)
-            for resource in resources:
-                with safexc:
-                    if not self.dryrun:
-                        ec2.delete_nat_gateway(NatGatewayId=resource.id)
-            return safexc
-
-        def delete_subnets(resources):
-            safexc = AWSSafeExec("delete_subnets", log=log)
-            for resource in resources:
-                with safexc:
-                    ec2.delete_subnet(SubnetId=resource.id, DryRun=self.dryrun)
-            return safexc
-
-        def delete_route_tables(resources):
-            safexc = AWSSafeExec("delete_route_tables", log=log)
-            for resource in resources:
-                is_main = False
-                for assoc in resource.raw.get("Associations", []):
-                    if assoc.get("Main", False):
-                        is_main = True
-                        continue
-                    with safexc:
-                        ec2.disassociate_route_table(
-                            AssociationId=assoc["RouteTableAssociationId"],
-                            DryRun=self.dryrun)
-                if is_main:
-                    continue  # main route tables are deleted with their VPC
-                with safexc:
-                    ec2.delete_route_table(RouteTableId=resource.id, DryRun=self.dryrun)
-            return safexc
-
-        def delete_security_groups(resources):
-            safexc = AWSSafeExec("delete_security_groups", log=log)
-            for resource in resources:
-                if resource.raw["GroupName"] == "default":
-                    continue  # default group cannot be deleted
-                with safexc:
-                    ec2.delete_security_group(GroupId=resource.id, DryRun=self.dryrun)
-            return safexc
-
-        ORDER = ["Instances", "KeyPairs", "RouteTables", "NetworkInterfaces", "SecurityGroups", "Subnets", "Addresses",
-                 "InternetGateways", "NatGateways", "Vpcs", ]
-        DELETE_FUNCS = {
-            "Instances": delete_instances,
-            "NetworkInterfaces": delete_network_interfaces,
-            "KeyPairs": delete_key_pairs,
-            "Vpcs": delete_vpcs,
-            "Addresses": delete_addresses,
-            "InternetGateways": delete_inet_gateways,
-            "NatGateways": delete_nat_gateways,
-            "Subnets": delete_subnets,
-            "RouteTables": delete_route_tables,
-            "SecurityGroups": delete_security_groups,
-        }
         all_errors = []
-        for res_type in ORDER:
-            FUNC = DELETE_FUNCS[res_type]
+        for res_type in self.ORDER:
             resources = self.resource_map.get(res_type, None)
             if resources:
                 log.info("Deleting %s: %s", res_type, str(resources))
-                safexc = FUNC(resources)
+                safexc = AWSSafeExec("delete_" + res_type, log=log)
+                for resource in resources:
+                    DELETE_FUNCS[res_type](ec2, resource, safexc, dryrun=self.dryrun)
                 if safexc.errors:
                     all_errors.extend(safexc.errors)
         return all_errors
-
-
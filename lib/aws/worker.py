@@ -1,86 +1,388 @@
-from threading import Thread
+from threading import Thread, Lock, Condition
+from collections import Counter, deque
+import time
 import queue
 import logging
 
+from ..metrics import METRICS
 from .api_helper import AwsAPIHelper
+from .retry import DelayedQueue, RetryPolicy, classify_error
+from .ratelimit import RATE_LIMITERS
+from .tasks import PRIORITY_INTERACTIVE, PRIORITY_ADMIN, PRIORITY_BULK
 
 
-QUEUE_TIMEOUT = 0.1  # seconds to sleep
 NUM_THREADS = 3
+TASK_AGING = 10  # seconds a task waits before being promoted to the upper priority class
+WORKER_IDLE_TIMEOUT = 60  # seconds an extra worker may stay idle before exiting
+GROW_LATENCY = 1.0  # seconds a task may wait in the queue before starting a new worker
+DRAIN_TIMEOUT = 30  # seconds to wait for the in-flight tasks at shutdown
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_ADMIN: "admin",
+    PRIORITY_BULK: "bulk",
+}
 
 log = logging.getLogger(__name__)
 
+TASK_WAIT = METRICS.histogram(
+    "aws_task_wait_seconds", "Time the AWS tasks waited in the queue before starting",
+    labels=("priority",))
+TASK_DURATION = METRICS.histogram(
+    "aws_task_duration_seconds", "Execution time of the AWS tasks (per attempt)",
+    labels=("task",))
+TASK_RETRIES = METRICS.counter(
+    "aws_task_retries_total", "Number of retried AWS task attempts", labels=("task", "kind"))
+TASK_FAILURES = METRICS.counter(
+    "aws_task_failures_total", "Number of failed AWS tasks", labels=("task", "outcome"))
+POOL_WORKERS = METRICS.gauge("aws_pool_workers", "Number of worker threads")
+POOL_IDLE = METRICS.gauge("aws_pool_idle_workers", "Number of idle worker threads")
+POOL_QUEUED = METRICS.gauge("aws_pool_queued_tasks", "Number of queued AWS tasks",
+                            labels=("priority",))
+POOL_DELAYED = METRICS.gauge("aws_pool_delayed_tasks", "Number of delayed (retried) AWS tasks")
+
+
+class PriorityTaskQueue():
+    """ Task queue with priority classes (`queue.Queue`-compatible consumer interface).
+
+    The highest priority class is served first (FIFO within a class), but a task's priority
+    is raised by one class for each `aging` seconds it waits, so the low priority work cannot
+    starve. """
+
+    def __init__(self, aging=TASK_AGING):
+        self._aging = aging
+        self._queues = {priority: deque() for priority in PRIORITY_NAMES}
+        self._cond = Condition()
+        self._unfinished = 0
+        self._waiting = 0  # number of blocked consumers
+        self._closed = False
+
+    def put(self, task):
+        """ Enqueues a task (using its priority class). Returns False if the queue was
+        closed. """
+        priority = task.priority if task.priority in self._queues else PRIORITY_ADMIN
+        with self._cond:
+            if self._closed:
+                return False
+            self._queues[priority].append((time.monotonic(), task))
+            self._unfinished += 1
+            self._cond.notify()
+            return True
+
+    def get(self, block=True, timeout=None):
+        """ Dequeues the next task. Raises `queue.Empty` if no task is available and
+        `QueueClosed` if the queue was closed and drained. """
+        with self._cond:
+            if block:
+                self._waiting += 1
+                try:
+                    self._cond.wait_for(lambda: self._qsize() or self._closed, timeout)
+                finally:
+                    self._waiting -= 1
+            if not self._qsize():
+                if self._closed:
+                    raise QueueClosed()
+                raise queue.Empty()
+            return self._pop()
+
+    def close(self):
+        """ Closes the queue: no more tasks are accepted and the consumers exit once the
+        queue is drained. """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def clear(self):
+        """ Removes and returns all the queued tasks. """
+        with self._cond:
+            tasks = [task for tasks in self._queues.values() for _, task in tasks]
+            for tasks_queue in self._queues.values():
+                tasks_queue.clear()
+            self._unfinished -= len(tasks)
+            self._cond.notify_all()
+            return tasks
+
+    def _pop(self):
+        now = time.monotonic()
+        best = None
+        for priority, tasks in self._queues.items():
+            if not tasks:
+                continue
+            enqueued = tasks[0][0]
+            effective = priority - int((now - enqueued) / self._aging)
+            if best is None or (effective, enqueued) < best[0]:
+                best = ((effective, enqueued), priority, tasks)
+        (_, enqueued), priority, tasks = best
+        TASK_WAIT.observe(now - enqueued, priority=PRIORITY_NAMES[priority])
+        return tasks.popleft()[1]
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._cond.notify_all()
+
+    def join(self):
+        """ Waits until all queued tasks were processed. """
+        with self._cond:
+            self._cond.wait_for(lambda: self._unfinished <= 0)
+
+    def _qsize(self):
+        return sum(len(tasks) for tasks in self._queues.values())
+
+    def qsize(self):
+        with self._cond:
+            return self._qsize()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def waiting(self):
+        """ The number of consumers blocked waiting for tasks. """
+        return self._waiting
+
+    def oldest_wait(self):
+        """ Returns the time (in seconds) the oldest queued task has been waiting. """
+        with self._cond:
+            heads = [tasks[0][0] for tasks in self._queues.values() if tasks]
+            return time.monotonic() - min(heads) if heads else 0
+
+    def depths(self):
+        """ Returns the queue depth of each priority class. """
+        with self._cond:
+            return {PRIORITY_NAMES[priority]: len(tasks)
+                    for priority, tasks in self._queues.items()}
+
+
+class QueueClosed(Exception):
+    pass
+
 
 class AwsWorkerThread(Thread):
     """ AWS command processing thread """
-    def __init__(self, queue, aws_config):
-        super().__init__()
+    def __init__(self, pool, queue, aws_config, on_retry=None, idle_timeout=None):
+        super().__init__(daemon=True)
+        self._pool = pool
         self._queue = queue
-        self._finished = False
+        self._on_retry = on_retry
+        self._idle_timeout = idle_timeout
         self._aws = AwsAPIHelper(aws_config)
         self.start()
 
     def run(self):
-        """ The thread's loop """
-        cur_task = None
-        cur_try = 1
-        while not self._finished:
+        """ The thread's loop (blocks until a task is queued, the queue is closed or the idle
+        timeout expires). """
+        while True:
             try:
-                if not cur_task:
-                    cur_task = self._queue.get(block=True, timeout=QUEUE_TIMEOUT)
-                    log.debug("Executing task: %s" % cur_task.__class__.__name__)
-                else:
-                    log.debug("Retrying task: %s [%i]", cur_task.__class__.__name__, cur_try)
-
-                result = cur_task.execute(self._aws)
-                if cur_task.future.set_running_or_notify_cancel():
-                    cur_task.future.set_result(result)
-                cur_task = None
-                cur_try = 1
-                self._queue.task_done()
-
+                task = self._queue.get(block=True, timeout=self._idle_timeout)
             except queue.Empty:
+                if self._pool._retire_worker(self):
+                    return
                 continue
-            except Exception as exc:
-                log.exception("Worker received an exception")
-                if cur_task and cur_task.retry and cur_task.retry < cur_task.retry:
-                    # retry task
-                    cur_try += 1
-                else:
-                    cur_task.future.set_exception(exc)
-                    cur_task = None
-                    self._queue.task_done()
+            except QueueClosed:
+                return
+            try:
+                self._execute(task)
+            finally:
+                self._queue.task_done()
+            self._pool._maybe_grow()
 
-    def shutdown(self):
-        """ Signals the shutdown signal to the thread """
-        self._finished = True
+    def _execute(self, task):
+        future = task.future
+        if not future.attempts and not future.set_running_or_notify_cancel():
+            return  # the task was cancelled
+        future.attempts += 1
+        task_name = task.__class__.__name__
+        log.debug("Executing task: %s [%i]", task_name, future.attempts)
+        try:
+            with TASK_DURATION.time(task=task_name):
+                result = task.execute(self._aws)
+        except Exception as exc:
+            if self._on_retry and self._on_retry(task, exc):
+                return  # the task was re-scheduled
+            log.exception("Worker received an exception")
+            # note: "exhausted" only if the task was actually retried (see `_retry_task`)
+            exhausted = task.retry and future.attempts > task.retry and classify_error(exc)
+            future.outcome = "exhausted" if exhausted else "failed"
+            TASK_FAILURES.inc(task=task_name, outcome=future.outcome)
+            future.set_exception(exc)
+        else:
+            future.outcome = "succeeded"
+            future.set_result(result)
 
 
 class ThreadPool:
-    """ Pool of threads consuming tasks from a queue """
+    """ Elastic pool of threads consuming tasks from a queue.
+
+    The pool starts with `num_threads` workers and grows (up to `max_threads`) while there are
+    more queued tasks than idle workers or the oldest task waited for more than
+    `grow_latency` seconds. The extra workers exit after `idle_timeout` idle seconds. """
 
-    def __init__(self, num_threads, aws_config):
-        self._queue = queue.Queue()
+    def __init__(self, num_threads, aws_config, aging=TASK_AGING, retry_policy=None,
+                 max_threads=None, idle_timeout=WORKER_IDLE_TIMEOUT, grow_latency=GROW_LATENCY):
+        self._queue = PriorityTaskQueue(aging=aging)
+        self._delayed = DelayedQueue()
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._retries = Counter()
+        RATE_LIMITERS.configure(aws_config.get("rate_limits", None))
+        AwsAPIHelper.build_client_config(aws_config)  # validates the client options
+        self._aws_config = aws_config  # note: shared with the workers
         self._threads = []
-        for _ in range(num_threads):
-            self._threads.append(AwsWorkerThread(self._queue, aws_config))
+        # single-flight registry of the deduplicated tasks: {dedupe_key: future}
+        self._inflight = {}
+        self._inflight_lock = Lock()
+        self._coalesced = Counter()
+        self._min_threads = num_threads
+        self._max_threads = max(num_threads, max_threads or num_threads)
+        self._idle_timeout = idle_timeout
+        self._grow_latency = grow_latency
+        self._threads_lock = Lock()
+        with self._threads_lock:
+            for _ in range(num_threads):
+                self._start_worker()
+        METRICS.add_collector(self._collect_metrics)
+
+    def _start_worker(self):
+        """ Starts a new worker. Note: use the threads lock before calling this! """
+        self._threads.append(AwsWorkerThread(
+            self, self._queue, self._aws_config, on_retry=self._retry_task,
+            idle_timeout=self._idle_timeout))
+
+    def _maybe_grow(self):
+        """ Starts a new worker if the queued tasks are not picked up fast enough. """
+        if len(self._threads) >= self._max_threads or self._queue.closed:
+            return
+        backlog = self._queue.qsize() > self._queue.waiting
+        if not backlog and self._queue.oldest_wait() < self._grow_latency:
+            return
+        with self._threads_lock:
+            if len(self._threads) < self._max_threads:
+                self._start_worker()
+                log.info("Thread pool grown to %i workers", len(self._threads))
+
+    def _retire_worker(self, worker):
+        """ Called by the idle workers: returns True if the worker should exit. """
+        with self._threads_lock:
+            if len(self._threads) <= self._min_threads:
+                return False
+            self._threads.remove(worker)
+            log.info("Thread pool shrunk to %i workers", len(self._threads))
+            return True
+
+    def _enqueue(self, task):
+        if not self._queue.put(task):
+            self._abort(task)
+            return
+        self._maybe_grow()
+
+    @staticmethod
+    def _abort(task):
+        """ Fails a task which could not be queued (the pool was shut down). """
+        if not task.future.cancel() and not task.future.done():
+            task.future.set_exception(RuntimeError("the thread pool was shut down"))
+
+    def queue_task(self, task, dedupe_key=None, delay=None):
+        """ Add a task to the queue (after `delay` seconds, if given). If a `dedupe_key` is
+        given (use it for read-only tasks only!) and an identical task is already queued or
+        running, the future of the in-flight task is returned instead of queueing another
+        copy. """
+        if dedupe_key is not None:
+            with self._inflight_lock:
+                future = self._inflight.get(dedupe_key, None)
+                if future is not None and not future.done():
+                    self._coalesced[dedupe_key] += 1
+                    log.debug("Coalesced task: %s", task.__class__.__name__)
+                    return future
+                self._inflight[dedupe_key] = task.future
+            task.future.add_done_callback(
+                lambda future: self._forget_inflight(dedupe_key, future))
 
-    def queue_task(self, task):
-        """ Add a task to the queue """
         log.debug("New task: %s", task.__class__.__name__)
-        self._queue.put(task)
+        if delay:
+            self._delayed.call_later(delay, self._enqueue, task)
+        else:
+            self._enqueue(task)
         return task.future
 
+    def call_later(self, delay, func, *args):
+        """ Calls a (quick!) function after a delay, e.g., to queue a task. """
+        self._delayed.call_later(delay, func, *args)
+
+    def _retry_task(self, task, exc):
+        """ Re-schedules a failed task through the delayed queue (if the error is retryable
+        and the task's retries were not exhausted). Called from the worker threads. """
+        kind = classify_error(exc)
+        if not kind or not task.retry or task.future.attempts > task.retry:
+            return False
+        delay = self._retry_policy.get_delay(task.future.attempts, kind)
+        log.warning("Retrying task %s in %.2fs (attempt %i, %s error: %s)",
+                    task.__class__.__name__, delay, task.future.attempts, kind, str(exc))
+        with self._inflight_lock:
+            self._retries[kind] += 1
+        TASK_RETRIES.inc(task=task.__class__.__name__, kind=kind)
+        self._delayed.call_later(delay, self._enqueue, task)
+        return True
+
+    def _forget_inflight(self, dedupe_key, future):
+        with self._inflight_lock:
+            if self._inflight.get(dedupe_key, None) is future:
+                del self._inflight[dedupe_key]
+
+    def get_stats(self):
+        """ Returns the pool's statistics. """
+        with self._inflight_lock:
+            return {
+                "workers": len(self._threads),
+                "idle": self._queue.waiting,
+                "queued": self._queue.qsize(),
+                "queued_by_class": self._queue.depths(),
+                "inflight": len(self._inflight),
+                "coalesced": {str(key): count for key, count in self._coalesced.items()},
+                "delayed": len(self._delayed),
+                "retries": dict(self._retries),
+                "rate_limits": RATE_LIMITERS.get_stats(),
+            }
+
+    def _collect_metrics(self):
+        """ Updates the pool's gauges (called before exporting the metrics). """
+        POOL_WORKERS.set(len(self._threads))
+        POOL_IDLE.set(self._queue.waiting)
+        POOL_DELAYED.set(len(self._delayed))
+        for priority, depth in self._queue.depths().items():
+            POOL_QUEUED.set(depth, priority=priority)
+
+    def invalidate_clients(self, aws_config=None):
+        """ Updates the AWS credentials / options (if given) and invalidates the workers'
+        cached sessions and clients. """
+        if aws_config:
+            AwsAPIHelper.build_client_config(aws_config)  # validates the client options
+            self._aws_config.update(aws_config)
+        AwsAPIHelper.invalidate_all()
+        log.info("AWS clients invalidated")
+
     def wait_completion(self):
         """ Wait for completion of all the tasks in the queue """
         self._queue.join()
 
-    def join(self):
-        """ Shuts down all threads """
+    def join(self, timeout=None):
+        """ Shuts down all threads: the queued / in-flight tasks are drained within `timeout`
+        seconds (if given), the remaining ones are cancelled. """
         log.info("Shutting down the thread pool...")
-        for thread in self._threads:
-            thread.shutdown()
-        for thread in self._threads:
-            thread.join()
-        log.info("Thread pool stopped!")
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self._queue.close()
+        # flush the delayed tasks (they are cancelled since the queue is closed)
+        self._delayed.shutdown()
+        with self._threads_lock:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()) if deadline is not None else None)
+        for task in self._queue.clear():
+            self._abort(task)
+        busy = sum(thread.is_alive() for thread in threads)
+        if busy:
+            log.warning("Thread pool stopped with %i busy workers!", busy)
+        else:
+            log.info("Thread pool stopped!")
 
@@ -0,0 +1,189 @@
+""" Lightweight in-process metrics (exported in the Prometheus text format). """
+
+import time
+import math
+from threading import Lock
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in pairs)
+    return "{" + ",".join('%s="%s"' % (name, value)
+                          for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric():
+    """ Base class of a (labelled) metric family. """
+    type = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}  # {label values: value}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def _samples(self):
+        """ Yields the (suffix, label values, extra label, value) samples. """
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield "", key, None, value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for suffix, key, extra, value in self._samples():
+            lines.append("%s%s%s %s" % (self.name, suffix,
+                                        _format_labels(self.label_names, key, extra),
+                                        _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """ Monotonically increasing counter. """
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """ Value which can go up and down. """
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """ Distribution of observed values (cumulative buckets + sum + count). """
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key, None)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][idx] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observes the duration of the enclosed block. """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, (list(series[0]), series[1], series[2]))
+                     for key, series in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", key, ("le", _format_value(float(bound))), cumulative
+            yield "_sum", key, None, total
+            yield "_count", key, None, count
+
+
+class TimedLock():
+    """ Lock recording the time spent waiting to acquire it (context manager only). """
+
+    def __init__(self, histogram, **labels):
+        self._lock = Lock()
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        if not self._lock.acquire(blocking=False):
+            start = time.monotonic()
+            self._lock.acquire()
+            self._histogram.observe(time.monotonic() - start, **self._labels)
+        else:
+            self._histogram.observe(0, **self._labels)
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+class MetricsRegistry():
+    """ The registry of metric families. The collectors are called before each export (e.g.,
+    to update the gauges of some current state). """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name, None)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric %s already registered as %s" % (name, metric.type))
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets=buckets)
+
+    def add_collector(self, func):
+        """ Registers a function to be called before exporting the metrics. """
+        with self._lock:
+            self._collectors.append(func)
+
+    def render(self):
+        """ Returns all metrics in the Prometheus text exposition format. """
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = list(self._metrics.values())
+        for collector in collectors:
+            collector()
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+# the process-wide metrics registry
+METRICS = MetricsRegistry()
@@ -1,7 +1,8 @@
 """ Model classes for the managed AWS resources (+ thread safe collections). """
 
-import pprint
 import re
+import sys
+from collections.abc import Mapping
 
 
 RESOURCE_TYPES = {
@@ -22,16 +23,92 @@ RESOURCE_TYPES = {
 class AWSResourceCollection():
     """ Encapsulates multiple AWS resources. """
 
-    def __init__(self, raw_resources=None):
-        self._collection = {}
+    def __init__(self, raw_resources=None, previous=None):
+        self._collection = {res_type: [] for res_type in RESOURCE_TYPES}
+        # owner -> type -> resources index (+ counts), built once the collection is complete
+        self._index = None
+        self._counts = None
+        # the previous snapshot's resources ({type: {id: resource}}), used for diffing
+        self._previous = None
+        self._changes = None
+        if previous is not None:
+            self._previous = {
+                res_type: {res.id: res for res in resources}
+                for res_type, resources in previous._collection.items()
+            }
         if not raw_resources:
             raw_resources = {}
         for res_type in RESOURCE_TYPES:
-            res = raw_resources.get(res_type, [])
-            if res:
-                self._collection[res_type] = normalize_resources(res_type, res)
-            else:
-                self._collection[res_type] = []
+            self.add_resources(res_type, raw_resources.get(res_type, []))
+        if raw_resources:
+            self.build_index()
+
+    def add_resources(self, res_type, raw_resources):
+        """ Normalizes and appends a (partial) list of raw resources of a type (e.g., a result
+        page). The unchanged resources of the previous snapshot are reused (without
+        normalizing them again, see `AWSResource.fingerprint`).
+        Note: pages of distinct types may be added concurrently. """
+        if not raw_resources:
+            return
+        if self._previous is None:
+            resources = normalize_resources(res_type, raw_resources)
+        else:
+            previous = self._previous.get(res_type, {})
+            id_key = RESOURCE_TYPES[res_type][0]
+            resources = []
+            for raw_data in raw_resources:
+                prev_res = previous.get(raw_data.get(id_key, ""), None)
+                if (prev_res is not None and
+                        prev_res.fingerprint == AWSResource.get_fingerprint(raw_data)):
+                    resources.append(prev_res)
+                    continue
+                res_obj = AWSResource(res_type=res_type, raw_data=raw_data)
+                if not res_obj.reserved:
+                    resources.append(res_obj)
+        self._collection[res_type].extend(resources)
+        self._index = None
+
+    def compute_changes(self):
+        """ Computes the changes from the previous snapshot (call it after all resources were
+        added). The reference to the previous snapshot is released afterwards. """
+        if self._changes is not None:
+            return self._changes
+        previous = self._previous or {}
+        changes = AWSResourceChangeSet()
+        for res_type in RESOURCE_TYPES:
+            prev_resources = previous.get(res_type, {})
+            current_ids = set()
+            for res in self._collection[res_type]:
+                current_ids.add(res.id)
+                prev_res = prev_resources.get(res.id, None)
+                if prev_res is None:
+                    changes.added.setdefault(res_type, []).append(res)
+                elif prev_res is not res:
+                    changes.changed.setdefault(res_type, []).append(res)
+            removed = [res_id for res_id in prev_resources if res_id not in current_ids]
+            if removed:
+                changes.removed[res_type] = removed
+        self._previous = None
+        self._changes = changes
+        return changes
+
+    def build_index(self):
+        """ Builds the owner index and the per-owner counts (unassigned resources are indexed
+        using the `None` owner). Call it after all resources were added. """
+        index = {}
+        for res_type in RESOURCE_TYPES:
+            for res in self._collection[res_type]:
+                index.setdefault(res.owner, {}).setdefault(res_type, []).append(res)
+        self._counts = {
+            owner: {res_type: len(resources) for res_type, resources in types.items()}
+            for owner, types in index.items()
+        }
+        self._index = index
+
+    def _get_index(self):
+        if self._index is None:
+            self.build_index()
+        return self._index, self._counts
 
     def get_size(self):
         """ Computes the size of the collection. """
@@ -42,50 +119,82 @@ class AWSResourceCollection():
 
     def get_stats(self, users):
         """ Returns the usage stats for each resource type. """
+        _, counts = self._get_index()
+        no_counts = {}
         stats = {
             "totals": {},
             "users": {},
             "unassigned": {},
         }
-        # pprint.pprint(self._collection)
+        unassigned = counts.get(None, no_counts)
         for res_type in RESOURCE_TYPES:
             stats["totals"][res_type] = len(self._collection[res_type])
-            for user in users:
-                stats["users"].setdefault(user, {})
-                stats["users"][user][res_type] = sum(
-                    res.owner == user for res in self._collection[res_type])
-            stats["unassigned"][res_type] = sum(
-                not res.owner for res in self._collection[res_type])
+            stats["unassigned"][res_type] = unassigned.get(res_type, 0)
+        for user in users:
+            user_counts = counts.get(user, no_counts)
+            stats["users"][user] = {
+                res_type: user_counts.get(res_type, 0) for res_type in RESOURCE_TYPES}
         return stats
 
     def get_filtered(self, filter_student=None):
         """ Returns filtered resource objects and / or IDs. """
-        filtered_resources = {}
-        for res_type in RESOURCE_TYPES:
-            resources = []
-            for resource in self._collection.get(res_type, []):
-                if filter_student and not resource.owner == filter_student:
-                    continue
-                resources.append(resource)
-            filtered_resources[res_type] = resources
-        return filtered_resources
+        if not filter_student:
+            return {res_type: list(self._collection[res_type]) for res_type in RESOURCE_TYPES}
+        index, _ = self._get_index()
+        owned = index.get(filter_student, {})
+        return {res_type: list(owned.get(res_type, [])) for res_type in RESOURCE_TYPES}
 
     def export(self):
         """ Exports the collection as standard object, """
-        return self._collection
+        return {res_type: [res.export() for res in resources]
+                for res_type, resources in self._collection.items()}
+
+
+class AWSResourceChangeSet():
+    """ The resources added, changed ({type: [resource]}) and removed ({type: [id]}) between two
+    consecutive snapshots. """
+    __slots__ = ("version", "added", "changed", "removed")
+
+    def __init__(self):
+        self.version = None
+        self.added = {}
+        self.changed = {}
+        self.removed = {}
+
+    def is_empty(self):
+        return not (self.added or self.changed or self.removed)
+
+    def export(self):
+        return {
+            "version": self.version,
+            "added": {res_type: [res.export() for res in resources]
+                      for res_type, resources in self.added.items()},
+            "changed": {res_type: [res.export() for res in resources]
+                        for res_type, resources in self.changed.items()},
+            "removed": dict(self.removed),
+        }
 
 
 class AWSResource():
-    """ Encapsulates the data for a generic AWS resource. """
+    """ Encapsulates the (compact) data for a generic AWS resource.
 
-    STUDENT_PATTERN = r'^(student[0-9]+)_.+'
+    Only the fields needed for the stats and the cleanup are retained from the raw
+    description (use the `RetrieveEC2ResourceRaw` task to fetch the full data). """
+
+    STUDENT_PATTERN = re.compile(r'^(student[0-9]+)_.+')
     RESERVED_PREFIX = "admin_"
 
-    __slots__ = ("res_type", "id", "name", "owner", "reserved", "raw")
+    FIELDS = ("res_type", "id", "name", "owner", "reserved", "state", "attachments",
+              "associations", "group_name", "links")
+    # the raw fields the resource is normalized from (their values form the fingerprint)
+    RAW_FIELDS = ("KeyName", "Tags", "TagSet", "State", "Attachments", "Associations",
+                  "GroupName", "VpcId", "SubnetId", "Attachment", "InstanceId",
+                  "NetworkInterfaceId", "SecurityGroups", "Groups", "NatGatewayAddresses")
+
+    __slots__ = FIELDS + ("fingerprint",)
 
     def __init__(self, res_type, raw_data):
-        self.res_type = res_type
-        self.raw = raw_data
+        self.res_type = sys.intern(res_type)
         res_desc = RESOURCE_TYPES[res_type]
         self.id = raw_data.get(res_desc[0], "")
         if len(res_desc) >= 2 and res_desc[1]:
@@ -94,9 +203,58 @@ class AWSResource():
             self.name = self._extract_tag(raw_data, "Name")
         self.owner = None
         self.reserved = self.name.startswith(self.RESERVED_PREFIX)
-        ownrm = re.match(self.STUDENT_PATTERN, self.name)
+        ownrm = self.STUDENT_PATTERN.match(self.name)
         if ownrm:
-            self.owner = ownrm.group(1)
+            self.owner = sys.intern(ownrm.group(1))
+
+        state = raw_data.get("State", None)
+        if isinstance(state, Mapping):
+            state = state.get("Name", None)
+        self.state = state
+        # the VPC IDs an internet gateway is attached to
+        self.attachments = tuple(
+            attach["VpcId"] for attach in raw_data.get("Attachments", ())
+            if "VpcId" in attach)
+        # route table associations: ((AssociationId, IsMain), ...)
+        self.associations = tuple(
+            (assoc.get("RouteTableAssociationId", None), assoc.get("Main", False))
+            for assoc in raw_data.get("Associations", ()))
+        self.group_name = raw_data.get("GroupName", None)
+        # references to the related resources: ((ResourceType, id), ...)
+        self.links = tuple(self._extract_links(res_type, raw_data))
+        self.fingerprint = self.get_fingerprint(raw_data)
+
+    @classmethod
+    def get_fingerprint(cls, raw_data):
+        """ Returns the values of the raw fields used by the normalization (compared for
+        equality to detect the unchanged resources cheaply). """
+        return tuple(raw_data.get(field, None) for field in cls.RAW_FIELDS)
+
+    @staticmethod
+    def _extract_links(res_type, raw_resource):
+        if res_type != "Vpcs" and raw_resource.get("VpcId", None):
+            yield ("Vpcs", raw_resource["VpcId"])
+        for attach in raw_resource.get("Attachments", ()):
+            if attach.get("VpcId", None):
+                yield ("Vpcs", attach["VpcId"])
+        if res_type != "Subnets" and raw_resource.get("SubnetId", None):
+            yield ("Subnets", raw_resource["SubnetId"])
+        for assoc in raw_resource.get("Associations", ()):
+            if assoc.get("SubnetId", None):
+                yield ("Subnets", assoc["SubnetId"])
+        instance_id = raw_resource.get("Attachment", {}).get("InstanceId", None)
+        if res_type != "Instances":
+            instance_id = raw_resource.get("InstanceId", instance_id)
+        if instance_id:
+            yield ("Instances", instance_id)
+        if res_type != "NetworkInterfaces" and raw_resource.get("NetworkInterfaceId", None):
+            yield ("NetworkInterfaces", raw_resource["NetworkInterfaceId"])
+        for group in raw_resource.get("SecurityGroups", raw_resource.get("Groups", ())):
+            if group.get("GroupId", None):
+                yield ("SecurityGroups", group["GroupId"])
+        for address in raw_resource.get("NatGatewayAddresses", ()):
+            if address.get("AllocationId", None):
+                yield ("Addresses", address["AllocationId"])
 
     @staticmethod
     def _extract_tag(raw_resource, name):
@@ -110,9 +268,17 @@ class AWSResource():
                 return tag["Value"].lower()
         return ""
 
+    def same_as(self, other):
+        """ Checks whether the other resource object describes the same resource state. """
+        return all(getattr(self, attr) == getattr(other, attr) for attr in self.FIELDS)
+
     def export(self):
         return {"res_type": self.res_type, "id": self.id, "name": self.name,
-                "owner": self.owner, "reserved": self.reserved, "raw": self.raw}
+                "owner": self.owner, "reserved": self.reserved, "state": self.state,
+                "attachments": list(self.attachments),
+                "associations": [list(assoc) for assoc in self.associations],
+                "group_name": self.group_name,
+                "links": [list(link) for link in self.links]}
 
     def __repr__(self):
         return "AWSResource" + str(self.export())
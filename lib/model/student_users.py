@@ -1,16 +1,38 @@
 """ Implements the student account collection classes. """
 
+import re
+import heapq
 import string
 import random
 from collections import OrderedDict
 from collections.abc import Mapping
 
 
+def generate_password(length=18):
+    """ Generates a new random password. """
+    chars = string.ascii_uppercase + string.ascii_lowercase + string.digits
+    return ''.join(random.choice(chars) for x in range(length))
+
+
+def natural_key(username):
+    """ Returns the sort key of an username in natural order (e.g., student2 < student10). """
+    return tuple(int(part) if part.isdigit() else part
+                 for part in re.split(r'(\d+)', username))
+
+
 class StudentAccountCollection():
     """ Implements the student accounts model collection. """
 
     def __init__(self, initialUsers):
         self._users = OrderedDict()
+        # free-list of the unallocated users (in natural order): a heap of (key, username)
+        # entries; the entries of the users allocated in the meantime are skipped when popped
+        self._free = []
+        self._free_names = set()
+        # warm pool: the free users whose passwords are being set ({username: password}) and
+        # the ones ready to be allocated (their login profile was confirmed)
+        self._warming = {}
+        self._ready = OrderedDict()
         self.load_persisted(initialUsers)
 
     def load_persisted(self, users):
@@ -23,6 +45,8 @@ class StudentAccountCollection():
             user_obj = self.get_user(user["username"], create=True)
             user_obj.password = user.get("password", None)
             user_obj.alloc_token = user.get("allocatedToken", None)
+            if not user_obj.alloc_token:
+                self._push_free(user_obj.username)
 
     def load_aws(self, aws_users):
         """ Loads the users' stats from the AWS API. """
@@ -38,6 +62,7 @@ class StudentAccountCollection():
             if create:
                 user_obj = StudentAccount(username=username)
                 self._users[username] = user_obj
+                self._push_free(username)
             else:
                 raise StudentAccountException("User '%s' not found" % username)
         return self._users[username]
@@ -47,30 +72,98 @@ class StudentAccountCollection():
         return self._users.keys()
 
     def allocate_user(self):
-        """ Allocates a new user and returns its data. Raises an exception if no
-        empty accounts were found. """
-        for user in self._users.values():
-            if user.alloc_token:
-                continue
+        """ Allocates the first free user (in natural order) and returns its data. Raises an
+        exception if no empty accounts were found. """
+        while self._free:
+            _, username = heapq.heappop(self._free)
+            self._free_names.discard(username)
+            user = self._users.get(username, None)
+            if user is None or user.alloc_token:
+                continue  # stale entry
             return self._allocate_user(user)
         raise StudentAccountException("no free accounts remaining")
 
+    def allocate_ready(self):
+        """ Allocates a user of the warm pool (its password is already set) and returns it
+        (None if no users are ready). """
+        while self._ready:
+            username, password = self._ready.popitem(last=False)
+            user = self._users.get(username, None)
+            if user is None or user.alloc_token or user.password != password:
+                continue  # stale entry
+            return self._allocate_user(user, password=password)
+        return None
+
+    def reserve_free(self, count, skip=None):
+        """ Takes up to `count` free users out of the free-list for the warm pool (except the
+        ones for which `skip(username)` returns True), generating their new passwords. """
+        reserved = []
+        skipped = []
+        while self._free and len(reserved) < count:
+            _, username = heapq.heappop(self._free)
+            self._free_names.discard(username)
+            user = self._users.get(username, None)
+            if user is None or user.alloc_token:
+                continue  # stale entry
+            if skip and skip(username):
+                skipped.append(username)
+                continue
+            user.password = generate_password()
+            self._warming[username] = user.password
+            reserved.append(user)
+        for username in skipped:
+            self._push_free(username)
+        return reserved
+
+    def set_warmed(self, username, success):
+        """ Marks a reserved user as ready (or returns it to the free-list on failure). """
+        password = self._warming.pop(username, None)
+        user = self._users.get(username, None)
+        if password is None or user is None or user.alloc_token or user.password != password:
+            return  # allocated / reset in the meantime
+        if success:
+            self._ready[username] = password
+        else:
+            user.password = None
+            self._push_free(username)
+
+    def has_free(self):
+        """ Checks whether there are free users left (excluding the warm pool). """
+        while self._free:
+            username = self._free[0][1]
+            user = self._users.get(username, None)
+            if user is not None and not user.alloc_token:
+                return True
+            heapq.heappop(self._free)  # stale entry
+            self._free_names.discard(username)
+        return False
+
+    @property
+    def warm_counts(self):
+        """ The number of (ready, warming) users of the warm pool. """
+        return len(self._ready), len(self._warming)
+
+    def _push_free(self, username):
+        if username not in self._free_names:
+            self._free_names.add(username)
+            heapq.heappush(self._free, (natural_key(username), username))
+
     def allocate_custom(self, username):
         """ Allocates / overrides (changes password & tokens) the specified user. """
         user_obj = self._users.get(username, None)
         if not user_obj:
             raise StudentAccountException("user '%s' not found!" % username)
+        self._ready.pop(username, None)
+        self._warming.pop(username, None)
         return self._allocate_user(user_obj)
 
-    def _allocate_user(self, user_obj):
+    def _allocate_user(self, user_obj, password=None):
         """ Allocates a specific user (overrides it if exists) and returns its data. Raises an
         exception if the user doesn't exist. """
-        # generate a new token and password
-        chars = string.ascii_uppercase + string.ascii_lowercase + string.digits
-        new_password = ''.join(random.choice(chars) for x in range(18))
+        # generate a new token and password (unless already set)
         new_token = hex(random.getrandbits(128))[2:]
         user_obj.alloc_token = new_token
-        user_obj.password = new_password
+        user_obj.password = password or generate_password()
         return user_obj
 
     def reset_user(self, username):
@@ -78,6 +171,9 @@ class StudentAccountCollection():
         if username not in self._users:
             raise StudentAccountException("User '%s' not found" % username)
         self._users[username].reset()
+        self._ready.pop(username, None)
+        self._warming.pop(username, None)
+        self._push_free(username)
 
     def export(self, persistent=False):
         """ Exports all user accounts as list of standard objects (for
@@ -100,6 +196,16 @@ class StudentAccount():
         self.password = None
         self.alloc_token = None
         
+    def same_as(self, other):
+        """ Checks whether the other user object has the same state. """
+        return (self.username == other.username and self.password == other.password and
+                self.alloc_token == other.alloc_token and self.aws_stats == other.aws_stats)
+
+    def copy(self):
+        """ Returns a (detached) copy of the user. """
+        return StudentAccount(username=self.username, password=self.password,
+                              allocatedToken=self.alloc_token, awsStats=dict(self.aws_stats))
+
     def update_stats(self, **stats):
         """ Updates the AWS stats for the user. """
         self.aws_stats.update(stats)
@@ -118,6 +224,46 @@ class StudentAccount():
         return obj
 
 
+class StudentAccountSnapshot():
+    """ Immutable snapshot of the student accounts (`{username: StudentAccount copy}`), for
+    lock-free reads. The version is increased by each new snapshot. """
+    __slots__ = ("users", "version", "_export")
+
+    def __init__(self, users, version=0):
+        self.users = users
+        self.version = version
+        self._export = None
+
+    def get_user(self, username):
+        user_obj = self.users.get(username, None)
+        if user_obj is None:
+            raise StudentAccountException("User '%s' not found" % username)
+        return user_obj
+
+    def export(self):
+        """ Exports the users (for web presentation). The result is cached, don't modify it! """
+        if self._export is None:
+            self._export = [user.export() for user in self.users.values()]
+        return self._export
+
+    def updated(self, users):
+        """ Returns a new snapshot with the given (changed) users replaced. """
+        new_users = dict(self.users)
+        for user_obj in users:
+            new_users[user_obj.username] = user_obj.copy()
+        return StudentAccountSnapshot(new_users, self.version + 1)
+
+    def same_as(self, users):
+        """ Checks whether the snapshot contains the same users (in the same state). """
+        if len(users) != len(self.users):
+            return False
+        for username, user_obj in users.items():
+            old_obj = self.users.get(username, None)
+            if old_obj is None or not old_obj.same_as(user_obj):
+                return False
+        return True
+
+
 class StudentAccountException(Exception):
     pass
 
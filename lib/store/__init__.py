@@ -3,10 +3,12 @@
 import os.path
 
 from ._file import FileStore
+from ._backend import create_backend
 from .users import StudentAccountsStore
 from .lab import LabVarsStore
 from .admin import AdminAuthStore
 from .aws_resources import AwsResourcesStore
+from .refresher import RefreshScheduler
 
 
 class ApplicationStore():
@@ -14,6 +16,10 @@ class ApplicationStore():
 
     DEFAULT_CONFIG = {
         "path": "./data",
+        "background_refresh": True,
+        "backend": "yaml",  # "yaml" (one file per store) or "sqlite"
+        "sqlite_file": "store.db",  # relative to `path`
+        "save_delay": 1.0,  # seconds to coalesce the file writes for (0 to write immediately)
         "users": {},
         "resources": {},
         "lab": {},
@@ -27,11 +33,44 @@ class ApplicationStore():
         for key in ["users", "lab", "admin"]:
             if "path" not in self._config[key]:
                 self._config[key]["path"] = self._config["path"]
+            self._config[key].setdefault("save_delay", self._config["save_delay"])
 
-        self._users = StudentAccountsStore(self._config["users"], thread_pool)
+        self._backend = create_backend(self._config)
+        self._users = StudentAccountsStore(self._config["users"], thread_pool,
+                                           backend=self._backend)
         self._resources = AwsResourcesStore(self._config["resources"], thread_pool)
-        self._lab = LabVarsStore(self._config["lab"])
-        self._admin = AdminAuthStore(self._config["admin"])
+        self._lab = LabVarsStore(self._config["lab"], backend=self._backend)
+        self._admin = AdminAuthStore(self._config["admin"], backend=self._backend)
+
+        self._scheduler = RefreshScheduler()
+        self._scheduler.add_job("admin_tokens", self._admin.sweep_interval,
+                                self._admin.sweep_expired)
+        if self._config["background_refresh"]:
+            self._scheduler.add_job("users", self._users.refresh_interval,
+                                    lambda: self._users.refresh_users(force=True))
+            self._scheduler.add_job("resources", self._resources.refresh_interval,
+                                    lambda: self._resources.refresh_resources(force=True))
+        if self._users.warm_pool_size:
+            self._scheduler.add_job("warm_pool", self._users.warm_interval,
+                                    self._users.fill_warm_pool)
+            self._users.on_allocate = lambda: self._scheduler.trigger("warm_pool")
+
+    def start(self):
+        """ Starts the background jobs (e.g., the refresh of the ephemeral stores). """
+        self._scheduler.start()
+
+    def stop(self):
+        """ Stops the background tasks and flushes the pending file writes. """
+        self._scheduler.shutdown()
+        self._resources.stop()
+        for store in (self._users, self._lab, self._admin):
+            store.flush()
+        self._backend.close()
+
+    @property
+    def background_refresh(self):
+        """ Whether the stores are kept fresh in background. """
+        return bool(self._config["background_refresh"])
 
     @property
     def users(self):
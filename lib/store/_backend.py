@@ -0,0 +1,164 @@
+""" Pluggable persistence backends of the data stores (yaml files or a sqlite database).
+
+A backend provides named tables of `{key: value}` rows (the values must be JSON / yaml
+serializable) supporting `load()`, `put()`, `put_many()`, `delete()` and `delete_many()`. """
+
+import os.path
+import json
+import sqlite3
+import logging
+from threading import Lock
+from collections.abc import Mapping
+
+from ._file import FileStore
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SQLITE_FILE = "store.db"
+
+
+class YamlTable(FileStore):
+    """ A table stored as a section of its own yaml file (the whole file is rewritten on each
+    change, see `FileStore`). The rows are either persisted as a list of objects identified by
+    their `key_field` or as a mapping. """
+
+    def __init__(self, file, section, key_field=None, save_delay=None):
+        super().__init__(file, save_delay=save_delay)
+        self._section = section
+        self._key_field = key_field
+        self._rows = {}
+        self._lock = Lock()
+
+    def load(self):
+        """ Loads and returns all rows. """
+        data = self._load_file() or {}
+        rows = data.get(self._section, None) or {}
+        if self._key_field:
+            if isinstance(rows, Mapping):
+                rows = rows.values()  # the older, mapping-shaped sections
+            rows = {row[self._key_field]: row for row in rows}
+        with self._lock:
+            self._rows = dict(rows)
+        return rows
+
+    def put(self, key, value):
+        with self._lock:
+            self._rows[key] = value
+            self._save()
+
+    def put_many(self, items):
+        with self._lock:
+            self._rows.update(items)
+            self._save()
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        with self._lock:
+            removed = [self._rows.pop(key, None) for key in keys]
+            if any(row is not None for row in removed):
+                self._save()
+
+    def _save(self):
+        """ Saves the rows to file. Note: use the lock before calling this! """
+        rows = list(self._rows.values()) if self._key_field else dict(self._rows)
+        self._save_file({self._section: rows})
+
+
+class YamlBackend():
+    """ Stores each table in a `<name>.yaml` file. """
+
+    def __init__(self, path, save_delay=None):
+        self._path = path
+        self._save_delay = save_delay
+        self._tables = []
+
+    def table(self, name, section, key_field=None, path=None):
+        """ Returns a table (stored in the given directory, if overridden). """
+        table = YamlTable(os.path.join(path or self._path, name + ".yaml"), section,
+                          key_field=key_field, save_delay=self._save_delay)
+        self._tables.append(table)
+        return table
+
+    def close(self):
+        """ Flushes the pending writes. """
+        for table in self._tables:
+            table.flush()
+
+
+class SqliteTable():
+    """ A table of (JSON-encoded) rows of the sqlite database, each change is a single
+    transaction. """
+
+    def __init__(self, backend, name):
+        self._backend = backend
+        self._name = name
+        backend.execute('CREATE TABLE IF NOT EXISTS "%s" ('
+                        'key TEXT PRIMARY KEY, value TEXT NOT NULL)' % name)
+
+    def load(self):
+        rows = self._backend.execute('SELECT key, value FROM "%s" ORDER BY rowid' % self._name)
+        return {key: json.loads(value) for key, value in rows}
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, items):
+        rows = [(key, json.dumps(value)) for key, value in items.items()]
+        if rows:
+            self._backend.execute_many(
+                'INSERT INTO "%s" (key, value) VALUES (?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET value = excluded.value' % self._name, rows)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        if keys:
+            self._backend.execute_many('DELETE FROM "%s" WHERE key = ?' % self._name,
+                                       [(key,) for key in keys])
+
+    def flush(self):
+        pass  # the changes are committed right away
+
+
+class SqliteBackend():
+    """ Stores the tables in a single sqlite database (in WAL mode). The connection is shared
+    by all threads (serialized by a lock). """
+
+    def __init__(self, db_file):
+        self._lock = Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    def table(self, name, section=None, key_field=None, path=None):
+        return SqliteTable(self, name)
+
+    def execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def execute_many(self, sql, rows):
+        """ Executes a statement for multiple rows in a single transaction. """
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(sql, rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_backend(config):
+    """ Creates the backend configured by the `data_store` config. """
+    backend = config.get("backend", "yaml")
+    if backend == "sqlite":
+        db_file = os.path.join(config["path"], config.get("sqlite_file", DEFAULT_SQLITE_FILE))
+        log.info("Using the sqlite data store (%s)", db_file)
+        return SqliteBackend(db_file)
+    if backend == "yaml":
+        return YamlBackend(config["path"], save_delay=config.get("save_delay", None))
+    raise ValueError("Invalid data store backend: %s" % backend)
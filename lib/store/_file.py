@@ -1,35 +1,115 @@
 """ Local yaml file-backed store. """
 
+import os
+import os.path
 import logging
+import tempfile
+from threading import Lock, Timer
 import yaml
 from collections import OrderedDict
-from collections.abc import Mapping
 
 log = logging.Logger("lib.store.FileStore")
 
+# use the (much faster) libyaml bindings, when available
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YamlDumper = getattr(yaml, "CDumper", yaml.Dumper)
+
+# the mode of the newly created files (`mkstemp` creates them as 0600)
+NEW_FILE_MODE = 0o644
+
 
 class FileStore():
+    """ Base class of the yaml file-backed stores.
+
+    The files are replaced atomically (temp file + fsync + rename). If a `save_delay` is given,
+    the saves are coalesced: only the last data saved within the delay is written (from a
+    background timer), so call `flush()` before exiting. """
 
-    def __init__(self, file):
+    def __init__(self, file, save_delay=None):
         self._file = file
+        self._save_delay = save_delay or 0
+        self._pending = None
+        self._timer = None
+        self._pending_lock = Lock()
+        self._write_lock = Lock()
 
     def _load_file(self):
         try:
             with open(self._file, 'r') as stream:
-                return yaml.safe_load(stream)
+                return yaml.load(stream, Loader=YamlLoader)
         except FileNotFoundError:
             log.warning("Data file '%s' not found", str(self._file))
             return None
         except:
-            log.exception("Error while reading '%s'")
+            log.exception("Error while reading '%s'", str(self._file))
             return None
 
     def _save_file(self, data):
+        """ Saves the data to file (the data must not be modified afterwards!). """
+        if not self._save_delay:
+            with self._write_lock:
+                self._write_file(data)
+            return
+        with self._pending_lock:
+            self._pending = data
+            if self._timer is None:
+                self._timer = Timer(self._save_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """ Writes the pending (coalesced) data to file. """
+        # note: the write lock orders the flushes, so an older snapshot never overwrites a newer
+        with self._write_lock:
+            with self._pending_lock:
+                data, self._pending = self._pending, None
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if data is not None:
+                self._write_file(data)
+
+    def _write_file(self, data):
+        """ Atomically replaces the file with the yaml-serialized data. """
+        directory = os.path.dirname(os.path.abspath(self._file))
+        tmp_path = None
         try:
-            with open(self._file, "w") as stream:
-                yaml.dump(data, stream, Dumper=yaml.Dumper)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=directory, prefix="." + os.path.basename(self._file) + ".", suffix=".tmp")
+            with os.fdopen(fd, "w") as stream:
+                yaml.dump(data, stream, Dumper=YamlDumper)
+                stream.flush()
+                os.fsync(stream.fileno())
+            try:
+                mode = os.stat(self._file).st_mode & 0o777
+            except FileNotFoundError:
+                mode = NEW_FILE_MODE
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, self._file)
+            tmp_path = None
+            self._fsync_dir(directory)
         except:
-            log.exception("Error while writing '%s'")
+            log.exception("Error while writing '%s'", str(self._file))
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _fsync_dir(directory):
+        """ Persists the rename (not supported on all platforms). """
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
 
 
 def represent_ordereddict(dumper, data):
@@ -45,4 +125,5 @@ def represent_ordereddict(dumper, data):
 
 
 yaml.add_representer(OrderedDict, represent_ordereddict)
-
+if YamlDumper is not yaml.Dumper:
+    yaml.add_representer(OrderedDict, represent_ordereddict, Dumper=YamlDumper)
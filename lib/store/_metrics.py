@@ -0,0 +1,12 @@
+""" The stores' metrics. """
+
+from lib.metrics import METRICS
+
+
+STORE_REFRESH = METRICS.histogram(
+    "store_refresh_seconds", "Duration of the stores' AWS refreshes", labels=("store",))
+STORE_SIZE = METRICS.gauge(
+    "store_snapshot_size", "Number of entries of the stores' last snapshot", labels=("store",))
+STORE_LOCK_WAIT = METRICS.histogram(
+    "store_lock_wait_seconds", "Time spent waiting for the stores' locks", labels=("store",),
+    buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
@@ -1,39 +1,61 @@
 """ Synchronized (multithread) store for the admin tokens. """
 
-import random
-import os.path
+import time
+import secrets
+import logging
 from threading import Lock
 
-from ._file import FileStore
+from ._backend import YamlBackend
 
+log = logging.getLogger(__name__)
 
-class AdminAuthStore(FileStore):
-    """ Persistent store for administrator authentication tokens. """
+
+class AdminAuthStore():
+    """ Persistent store for administrator authentication tokens.
+
+    The tokens expire after the configured TTL. The `{token: expiry}` map is never modified in
+    place (a new map is swapped in on each change), so the tokens are checked without
+    locking. """
+
+    DEFAULT_CONFIG = {
+        "token_ttl": 12 * 3600,  # seconds
+        "sweep_interval": 600,  # seconds between the expired tokens cleanups
+    }
 
     # persist the authentication status of the admins
-    AUTH_FILE = "admin_auth.yaml"
+    AUTH_TABLE = "admin_auth"
 
-    def __init__(self, store_config):
-        file_path = os.path.join(store_config["path"], self.AUTH_FILE)
-        super().__init__(file_path)
+    def __init__(self, store_config, backend=None):
+        if backend is None:
+            backend = YamlBackend(store_config["path"], store_config.get("save_delay", None))
+        self._table = backend.table(self.AUTH_TABLE, section="auth", path=store_config["path"])
 
-        self._config = store_config
-        self._lock = Lock()
+        self._config = dict(self.DEFAULT_CONFIG)
+        self._config.update(store_config)
+        self._lock = Lock()  # serializes the changes only
         self._auth = {}
         self.reload()
 
     def reload(self):
         """ Reloads the file. """
         with self._lock:
-            self._auth = {}
-            auth_data = self._load_file()
-            if auth_data:
-                self._auth = auth_data.get("auth", {})
+            auth = {}
+            legacy = {}
+            legacy_expiry = time.time() + self._config["token_ttl"]
+            for token, expiry in self._table.load().items():
+                if expiry is True:
+                    # the legacy (non-expiring) tokens are considered issued now
+                    legacy[token] = expiry = legacy_expiry
+                auth[token] = expiry
+            self._auth = auth
+            if legacy:
+                # persist their expiry (else they would get a fresh TTL on each restart)
+                self._table.put_many(legacy)
 
     def check_auth_token(self, auth_token):
-        """ Checks the auth token of the admin. """
-        with self._lock:
-            return auth_token in self._auth
+        """ Checks the auth token of the admin (lock-free). """
+        expiry = self._auth.get(auth_token, None)
+        return isinstance(expiry, (int, float)) and expiry > time.time()
 
     def authenticate(self, user, password):
         """ Checks the username and password and authenticates the admin. """
@@ -43,14 +65,30 @@ class AdminAuthStore(FileStore):
         if admin_cfg["username"] != user or admin_cfg["password"] != password:
             return None
         with self._lock:
-            new_token = hex(random.getrandbits(256))[2:]
-            self._auth[new_token] = True
-            # TODO: store date and cleanup old entries
-            self._save()
+            new_token = secrets.token_hex(32)
+            expiry = time.time() + self._config["token_ttl"]
+            auth = dict(self._auth)
+            auth[new_token] = expiry
+            self._auth = auth
+            self._table.put(new_token, expiry)
             return new_token
 
-    def _save(self):
-        """ Saves the lab vars back to file. Note: use a lock before calling this! """
-        self._save_file({
-            "auth": self._auth
-        })
+    @property
+    def sweep_interval(self):
+        return self._config["sweep_interval"]
+
+    def sweep_expired(self):
+        """ Removes the expired tokens. """
+        with self._lock:
+            now = time.time()
+            expired = [token for token, expiry in self._auth.items() if expiry <= now]
+            if not expired:
+                return
+            self._auth = {token: expiry for token, expiry in self._auth.items()
+                          if expiry > now}
+            self._table.delete_many(expired)
+        log.info("Removed %i expired admin tokens", len(expired))
+
+    def flush(self):
+        """ Writes the pending changes (if the backend delays them). """
+        self._table.flush()
@@ -3,12 +3,17 @@
 import time
 import os.path
 import logging
-from threading import Lock
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 from ..aws.tasks import (
     RetrieveStudentUsers, ChangeUserPassword, RetrieveEC2Resources,
-    CleanupUserResourcesTask
+    RetrieveEC2ResourceRaw, CleanupUserResourcesTask
 )
+from ..aws.cleanup import ParallelCleanup
+from .jobs import CleanupJob, JobRegistry
+from ._metrics import STORE_LOCK_WAIT, STORE_REFRESH, STORE_SIZE
+from lib.metrics import TimedLock
 from lib.model.aws import AWSResource, AWSResourceCollection
 
 
@@ -21,6 +26,17 @@ class AwsResourcesStore():
     DEFAULT_CONFIG = {
         "refresh": 20,  # seconds
         "timeout": 20,  # seconds
+        "concurrent_fetch": True,  # run the describe calls in parallel
+        "fetch_workers": None,  # shared describe executor size (defaults to one per type)
+        "page_size": None,  # use the API's default page size
+        "changes_history": 50,  # number of change sets to retain
+        "parallel_cleanup": True,  # delete the independent resources concurrently
+        "converge_cleanup": True,  # wait for the deletions / retry the busy resources
+        "cleanup_deadline": 300,  # seconds
+        "cleanup_timeout": 600,  # seconds to wait for a (non-converging) cleanup round
+        "cleanup_margin": 30,  # seconds to wait for a converging cleanup past its deadline
+        "cleanup_jobs": 2,  # maximum number of concurrently running cleanup jobs
+        "jobs_history": 20,  # maximum number of cleanup jobs to retain
         "users": {},
     }
 
@@ -30,8 +46,16 @@ class AwsResourcesStore():
         self._thread_pool = thread_pool
 
         self._collection = AWSResourceCollection()
-        self._lock = Lock()
+        self._lock = TimedLock(STORE_LOCK_WAIT, store="resources")
         self._last_fetch = None
+        self._last_update = None
+        # the change sets between the consecutive snapshots
+        self._version = 0
+        self._changes = deque(maxlen=self._config["changes_history"])
+        # the asynchronous cleanup jobs
+        self._jobs = JobRegistry(self._config["jobs_history"])
+        self._job_executor = ThreadPoolExecutor(max_workers=self._config["cleanup_jobs"],
+                                                thread_name_prefix="cleanup")
 
     def refresh_resources(self, force=False):
         """ Loads / updates the existing AWS resources. """
@@ -43,31 +67,140 @@ class AwsResourcesStore():
                 need_refresh = True
         # execute the task outside the lock
         if need_refresh:
-            collect = AWSResourceCollection(self._fetch_resources())
+            with STORE_REFRESH.time(store="resources"):
+                collect = self._fetch_resources()
+                changes = collect.compute_changes()
+                if not changes.is_empty():
+                    collect.build_index()
+            STORE_SIZE.set(collect.get_size(), store="resources")
             log.info("Refreshed AWS resources (%s)", collect.get_size())
             with self._lock:
-                self._collection = collect
+                self._last_update = time.time()
+                # keep the previous (identical) snapshot if nothing changed
+                # (note: coalesced refreshes return the same collection object)
+                if not changes.is_empty() and self._collection is not collect:
+                    self._collection = collect
+                    self._version += 1
+                    changes.version = self._version
+                    self._changes.append(changes)
 
-    def clean_aws_resources(self, username):
-        """ Runs the AWS cleanup task. """
+    def start_cleanup(self, username):
+        """ Starts an asynchronous AWS cleanup job (all users if `username` is None) and returns
+        it. """
+        job = self._jobs.add(CleanupJob(username))
+        self._job_executor.submit(self._run_cleanup_job, job)
+        return job
+
+    def get_cleanup_job(self, job_id):
+        """ Returns a cleanup job by its ID (None if not found). """
+        return self._jobs.get(job_id)
+
+    def _run_cleanup_job(self, job):
+        try:
+            errors = self.clean_aws_resources(job.username, job=job)
+        except Exception as exc:
+            log.exception("Cleanup job %s failed", job.id)
+            job.finish(exception=exc)
+        else:
+            job.finish(errors)
+
+    def clean_aws_resources(self, username, job=None):
+        """ Runs the AWS cleanup task (blocking, use `start_cleanup` from the web threads).
+        In convergence mode, the cleanup is repeated (until the deadline) while the user's
+        resources could not be deleted. """
+        deadline = None
+        if self._config["parallel_cleanup"] and self._config["converge_cleanup"]:
+            deadline = time.time() + self._config["cleanup_deadline"]
+        on_progress = job.on_progress if job else None
         self.refresh_resources()
         resources = self._collection.get_filtered(filter_student=username)
-        task = CleanupUserResourcesTask(resource_map=resources, dryrun=False)
-        future = self._thread_pool.queue_task(task)
-        future.add_done_callback(lambda _: self.refresh_resources(force=True))
-        return future.result()
+        while True:
+            size = sum(len(res_list) for res_list in resources.values())
+            if job:
+                job.begin_round(resources)
+            if self._config["parallel_cleanup"]:
+                future = ParallelCleanup(self._thread_pool, resources, dryrun=False,
+                                         deadline=deadline, on_progress=on_progress).start()
+            else:
+                task = CleanupUserResourcesTask(resource_map=resources, dryrun=False)
+                future = self._thread_pool.queue_task(task)
+            if deadline:
+                timeout = max(0, deadline - time.time()) + self._config["cleanup_margin"]
+            else:
+                timeout = self._config["cleanup_timeout"]
+            try:
+                errors = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                raise TimeoutError("the cleanup did not finish within %.1fs" % timeout) from None
+            if on_progress and not self._config["parallel_cleanup"]:
+                on_progress([res for res_list in resources.values() for res in res_list],
+                            errors)
+            # note: refresh from the caller's thread (a worker must not wait for another task)
+            self.refresh_resources(force=True)
+            if not errors or not deadline or time.time() >= deadline:
+                return errors
+            resources = self._collection.get_filtered(filter_student=username)
+            if sum(len(res_list) for res_list in resources.values()) >= size:
+                return errors  # no progress was made
+            log.info("Cleanup incomplete (%s errors), retrying", len(errors))
+
+    @property
+    def converge_cleanup(self):
+        """ Whether the cleanup waits for the resources to be actually deleted. """
+        return bool(self._config["parallel_cleanup"] and self._config["converge_cleanup"])
+
+    def stop(self):
+        """ Stops the cleanup jobs executor (the queued jobs are cancelled). """
+        self._job_executor.shutdown(wait=False, cancel_futures=True)
 
     def _fetch_resources(self):
-        """ Executes the resources polling task and returns the newly discovered resources. """
-        task = RetrieveEC2Resources()
+        """ Executes the resources polling task and returns the newly discovered resources
+        collection. """
+        task = RetrieveEC2Resources(
+            collection=AWSResourceCollection(previous=self._collection),
+            concurrent=self._config["concurrent_fetch"],
+            max_workers=self._config["fetch_workers"],
+            page_size=self._config["page_size"])
+        task_future = self._thread_pool.queue_task(task, dedupe_key="RetrieveEC2Resources")
+        return task_future.result(timeout=self._config["timeout"])
+
+    @property
+    def refresh_interval(self):
+        return self._config["refresh"]
+
+    def get_raw_resource(self, res_type, res_id):
+        """ Fetches the full (raw) AWS description of a resource (for debugging). """
+        task = RetrieveEC2ResourceRaw(res_type=res_type, res_id=res_id)
         task_future = self._thread_pool.queue_task(task)
         return task_future.result(timeout=self._config["timeout"])
 
-    def get_stats(self, users):
+    def get_age(self):
+        """ Returns the age (in seconds) of the resources snapshot (None if never fetched). """
+        last_update = self._last_update
+        return time.time() - last_update if last_update else None
+
+    def get_changes(self, since_version):
+        """ Returns the current version and the list of change sets after the given version.
+        The change sets are None if they are no longer available (a full export is needed). """
         with self._lock:
-            return self._collection.get_stats(users)
+            version = self._version
+            if since_version >= version:
+                return version, []
+            if not self._changes or self._changes[0].version > since_version + 1:
+                return version, None
+            return version, [changes.export() for changes in self._changes
+                             if changes.version > since_version]
+
+    @property
+    def version(self):
+        """ The version of the current snapshot. """
+        return self._version
+
+    def get_stats(self, users):
+        """ Returns the resource stats of the given users (lock-free: the collections are not
+        modified once published). """
+        return self._collection.get_stats(users)
 
     def export(self):
-        """ Returns the collection resources as standard object. """
-        with self._lock:
-            return self._collection.export()
+        """ Returns the collection resources as standard object (lock-free). """
+        return self._collection.export()
@@ -0,0 +1,118 @@
+""" In-memory registry of the (asynchronous) cleanup jobs. """
+
+import time
+import random
+from threading import Lock
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from lib.model.aws import RESOURCE_TYPES
+
+
+def format_error(err):
+    """ Formats an AWS error as user-friendly message. """
+    if isinstance(err, ClientError):
+        return str(err.operation_name) + ": " + err.response["Error"]["Message"]
+    return str(err)
+
+
+class CleanupJob():
+    """ Tracks the progress of an AWS resources cleanup. """
+
+    def __init__(self, username):
+        self.id = hex(random.getrandbits(64))[2:]
+        self.username = username
+        self.status = "running"
+        self.started = time.time()
+        self.finished = None
+        self._lock = Lock()
+        self._resources = {}  # {(res_type, id): None / True (deleted) / False (failed)}
+        self._errors = []
+
+    @property
+    def done(self):
+        return self.status != "running"
+
+    def begin_round(self, resource_map):
+        """ Registers the resources of a new cleanup round. """
+        with self._lock:
+            self._errors = []
+            for resources in resource_map.values():
+                for res in resources:
+                    self._resources.setdefault((res.res_type, res.id), None)
+
+    def on_progress(self, resources, errors):
+        """ Records the result of some resource deletions (called from the worker threads). """
+        with self._lock:
+            for res in resources:
+                self._resources[(res.res_type, res.id)] = not errors
+            self._errors.extend(format_error(err) for err in errors)
+
+    def finish(self, errors=None, exception=None):
+        """ Marks the job as finished (the errors of the last round are retained). """
+        with self._lock:
+            if exception is not None:
+                self._errors.append(format_error(exception))
+                self.status = "failed"
+            else:
+                self._errors = [format_error(err) for err in errors or []]
+                self.status = "failed" if self._errors else "finished"
+            self.finished = time.time()
+
+    def export(self):
+        """ Exports the job's status as standard object. """
+        with self._lock:
+            progress = {res_type: {"total": 0, "deleted": 0, "errors": 0}
+                        for res_type in RESOURCE_TYPES}
+            for (res_type, _), deleted in self._resources.items():
+                progress[res_type]["total"] += 1
+                if deleted:
+                    progress[res_type]["deleted"] += 1
+                elif deleted is False:
+                    progress[res_type]["errors"] += 1
+            return {
+                "id": self.id,
+                "username": self.username,
+                "status": self.status,
+                "started": self.started,
+                "finished": self.finished,
+                "progress": progress,
+                "errors": list(self._errors),
+            }
+
+
+class JobRegistry():
+    """ Bounded registry of jobs (the oldest finished jobs are evicted first). """
+
+    def __init__(self, max_jobs=20):
+        self._max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = Lock()
+
+    def add(self, job):
+        """ Registers a new job. Raises an exception if too many jobs are still running. """
+        with self._lock:
+            if len(self._jobs) >= self._max_jobs:
+                for job_id, old_job in self._jobs.items():
+                    if old_job.done:
+                        del self._jobs[job_id]
+                        break
+                else:
+                    raise JobRegistryException("too many jobs are already running")
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        """ Returns a job by its ID (None if not found / evicted). """
+        with self._lock:
+            return self._jobs.get(job_id, None)
+
+    def list(self):
+        """ Returns all registered jobs. """
+        with self._lock:
+            return list(self._jobs.values())
+
+
+class JobRegistryException(Exception):
+    pass
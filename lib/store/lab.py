@@ -1,20 +1,20 @@
 """ Synchronized (multithread) store for the lab vars. """
 
-import os.path
 from threading import Lock
 
-from ._file import FileStore
+from ._backend import YamlBackend
 
 
-class LabVarsStore(FileStore):
+class LabVarsStore():
     """ Persistent store for lab variables. """
 
-    LAB_FILE = "lab.yaml"
+    LAB_TABLE = "lab"
     LAB_DEFAULTS = {"password": None}
 
-    def __init__(self, store_config):
-        file_path = os.path.join(store_config["path"], self.LAB_FILE)
-        super().__init__(file_path)
+    def __init__(self, store_config, backend=None):
+        if backend is None:
+            backend = YamlBackend(store_config["path"], store_config.get("save_delay", None))
+        self._table = backend.table(self.LAB_TABLE, section="lab", path=store_config["path"])
 
         self._config = store_config
         self._lock = Lock()
@@ -24,10 +24,7 @@ class LabVarsStore(FileStore):
         """ Reloads the lab config from file. """
         with self._lock:
             self._lab = dict(self.LAB_DEFAULTS)
-            lab = self._load_file()
-            if lab:
-                lab = lab.get("lab", {})
-                self._lab.update(lab)
+            self._lab.update(self._table.load())
 
     def check_password(self, lab_password):
         """ Checks the lab's password. """
@@ -44,10 +41,8 @@ class LabVarsStore(FileStore):
         """ Changes the lab password """
         with self._lock:
             self._lab["password"] = new_password
-            self._save()
+            self._table.put("password", new_password)
 
-    def _save(self):
-        """ Saves the lab vars back to file. Note: use a lock before calling this! """
-        self._save_file({
-            "lab": self._lab
-        })
+    def flush(self):
+        """ Writes the pending changes (if the backend delays them). """
+        self._table.flush()
@@ -0,0 +1,94 @@
+""" Background scheduler keeping the ephemeral stores warm. """
+
+import time
+import logging
+from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class RefreshJob():
+    """ A periodic job registered with the scheduler. """
+    __slots__ = ("name", "interval", "func", "next_run", "future")
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.next_run = 0
+        self.future = None
+
+    @property
+    def running(self):
+        return self.future is not None and not self.future.done()
+
+
+class RefreshScheduler():
+    """ Periodically runs the registered jobs on their own intervals. The due jobs are executed
+    in parallel (a job is never started again while its previous run is still in progress, so
+    by default each job gets its own worker and a slow job cannot delay the others).
+
+    The scheduler may be started again after a shutdown (e.g., on an engine restart): each run
+    uses its own thread and executor. """
+
+    def __init__(self, max_parallel=None):
+        self._jobs = []
+        self._max_parallel = max_parallel
+        self._wakeup = Event()
+        self._lock = Lock()
+        self._executor = None  # the current run's executor (None when stopped)
+
+    def add_job(self, name, interval, func):
+        """ Registers a new periodic job (call before starting the scheduler). """
+        self._jobs.append(RefreshJob(name, interval, func))
+
+    def trigger(self, name):
+        """ Runs a job as soon as possible (e.g., when its data changed). """
+        with self._lock:
+            for job in self._jobs:
+                if job.name == name:
+                    job.next_run = 0
+        self._wakeup.set()
+
+    def start(self):
+        """ Starts the scheduler's thread (no-op if already running). """
+        with self._lock:
+            if self._executor is not None:
+                return
+            max_workers = self._max_parallel or max(1, len(self._jobs))
+            self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                                thread_name_prefix="refresh")
+            Thread(target=self.run, args=(self._executor,), name="RefreshScheduler",
+                   daemon=True).start()
+
+    def run(self, executor):
+        """ The scheduler's loop (exits once its executor was shut down). """
+        while True:
+            with self._lock:
+                # note: the jobs are only submitted while holding the lock (see `shutdown`)
+                if self._executor is not executor:
+                    return
+                now = time.time()
+                for job in self._jobs:
+                    if job.next_run <= now and not job.running:
+                        job.next_run = now + job.interval
+                        job.future = executor.submit(self._run_job, job)
+                next_run = min((job.next_run for job in self._jobs), default=now + 1)
+            self._wakeup.wait(max(0.1, next_run - time.time()))
+            self._wakeup.clear()
+
+    def _run_job(self, job):
+        try:
+            job.func()
+        except Exception:
+            log.exception("Background refresh job '%s' failed", job.name)
+
+    def shutdown(self):
+        """ Stops the scheduler (the running jobs are left to finish). """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        self._wakeup.set()
+        executor.shutdown(wait=False)
@@ -1,45 +1,74 @@
 """ Synchronized (multithread) store for the student accounts. """
 
+import re
 import time
-import os.path
 import logging
-from threading import Lock
+from threading import Lock, Condition
+from collections import OrderedDict, deque
+from concurrent.futures import wait, FIRST_COMPLETED
 
-from lib.aws.tasks import RetrieveStudentUsers, ChangeUserPassword, RemoveUserProfile
-from lib.model.student_users import StudentAccountCollection
-from ._file import FileStore
+from lib.aws.tasks import (
+    RetrieveStudentUsers, ChangeUserPassword, ConfirmLoginProfile, RemoveUserProfile,
+    PRIORITY_ADMIN, PRIORITY_BULK
+)
+from lib.model.student_users import (
+    StudentAccountCollection, StudentAccountSnapshot, StudentAccountException
+)
+from lib.metrics import TimedLock
+from ._backend import YamlBackend
+from ._metrics import STORE_LOCK_WAIT, STORE_REFRESH, STORE_SIZE
 
 log = logging.getLogger(__name__)
 
 
-class StudentAccountsStore(FileStore):
+class StudentAccountsStore():
     """ Persistent store for the student users. """
 
     DEFAULT_CONFIG = {
         "refresh": 10,  # seconds
         "timeout": 10,  # seconds
-        "pattern": r'student[0-9]+'
+        "pattern": r'student[0-9]+',
+        "path_prefix": None,  # IAM path prefix of the student users (e.g., "/students/")
+        "warm_pool": 0,  # number of free users to keep ready (with their passwords set)
+        "warm_interval": 5,  # seconds between the warm pool checks
+        "bulk_concurrency": 8,  # maximum number of concurrent IAM calls of a bulk allocation
     }
 
-    USERS_FILE = "student_users.yaml"
+    USERS_TABLE = "student_users"
 
-    def __init__(self, store_config, thread_pool):
-        file_path = os.path.join(store_config["path"], self.USERS_FILE)
-        super().__init__(file_path)
+    def __init__(self, store_config, thread_pool, backend=None):
+        if backend is None:
+            backend = YamlBackend(store_config["path"], store_config.get("save_delay", None))
+        self._table = backend.table(self.USERS_TABLE, section="users", key_field="username",
+                                    path=store_config["path"])
 
         self._config = dict(self.DEFAULT_CONFIG)
         self._config.update(store_config)
 
         self._thread_pool = thread_pool
+        self._pattern = re.compile(self._config["pattern"])
         self._collection = StudentAccountCollection([])
-        self._lock = Lock()
+        self._lock = TimedLock(STORE_LOCK_WAIT, store="users")
         self._last_fetch = None
+        self._last_update = None
 
-        # load the store from file
-        users = self._load_file()
-        if users:
-            users = users.get("users", None)
+        # load the persisted users
+        users = self._table.load()
         self._collection.load_persisted(users)
+        self._persisted = set(users)
+        # the published (immutable) snapshot, replaced after each change
+        self._snapshot = StudentAccountSnapshot({})
+        self._publish_all()
+        # the rows to persist (outside the store lock): {username: row}
+        self._pending_writes = OrderedDict()
+        self._drain_lock = Lock()
+        # the pending login profile removals: {username: future}
+        self._removals = {}
+        # the warm pool's pending password changes: {username: future}
+        self._warm_ups = {}
+        # notified when the warm pool changes
+        self._warm_cond = Condition()
+        self.on_allocate = None  # called after allocating a user of the warm pool
 
     def refresh_users(self, force=False):
         """ Loads / updates the existing AWS users and returns the updated collection. """
@@ -51,80 +80,349 @@ class StudentAccountsStore(FileStore):
                 need_refresh = True
         # execute the task outside the lock
         if need_refresh:
-            aws_users = self._fetch_aws_users()
+            # note: the users are loaded into the collection page by page
+            with STORE_REFRESH.time(store="users"):
+                aws_users = self._fetch_aws_users()
             log.info("Refreshed AWS users (%s)", len(aws_users))
             with self._lock:
-                self._collection.load_aws(aws_users)
-                self._save()
+                self._persist_new()
+                self._last_update = time.time()
+                STORE_SIZE.set(len(self._collection.get_users()), store="users")
+            self._drain_writes()
 
         return self.export()
 
     def export(self):
-        """ Returns the student users as standard object. """
-        with self._lock:
-            return self._collection.export(persistent=False)
+        """ Returns the student users as standard object (lock-free, from the current
+        snapshot). """
+        return self._snapshot.export()
+
+    @property
+    def refresh_interval(self):
+        return self._config["refresh"]
+
+    def get_age(self):
+        """ Returns the age (in seconds) of the AWS users data (None if never fetched). """
+        last_update = self._last_update
+        return time.time() - last_update if last_update else None
 
     def get_user(self, username):
-        """ Returns a specific user's object. """
-        with self._lock:
-            return self._collection.get_user(username)
+        """ Returns a specific user's object (a lock-free, read-only copy). """
+        return self._snapshot.get_user(username)
 
     def allocate_user(self):
-        """ Tries to allocate an unused user account. """
-        user_obj = None
-        with self._lock:
-            user_obj = self._collection.allocate_user()
-            self._save()
-        self._change_aws_password(user_obj.username, user_obj.password)
+        """ Tries to allocate an unused user account (a ready one of the warm pool first). If
+        only warming accounts remain, waits for them (up to the configured timeout). """
+        deadline = time.time() + self._config["timeout"]
+        # note: the allocation is committed in memory, the disk I/O happens outside the lock
+        with self._warm_cond:
+            while True:
+                with self._lock:
+                    user_obj = self._collection.allocate_ready()
+                    ready = user_obj is not None
+                    if not ready and (self._collection.has_free() or
+                                      not self._collection.warm_counts[1]):
+                        user_obj = self._collection.allocate_user()
+                    if user_obj is not None:
+                        self._persist(user_obj.username)
+                        break
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._warm_cond.wait(remaining):
+                    raise StudentAccountException("no free accounts remaining")
+        self._drain_writes()
+        if ready:
+            if self.on_allocate:
+                self.on_allocate()  # refill the warm pool
+        else:
+            self._change_aws_password(user_obj.username, user_obj.password)
         return user_obj
 
-    def allocate_custom_users(self, users):
-        """ Forcefully allocates the specified users. """
+    @property
+    def warm_pool_size(self):
+        return self._config["warm_pool"]
+
+    @property
+    def warm_interval(self):
+        return self._config["warm_interval"]
+
+    def fill_warm_pool(self):
+        """ Sets the passwords of free users (in background) until the warm pool is full. """
         with self._lock:
-            for username in users:
-                user_obj = self._collection.allocate_custom(username)
-                self._change_aws_password(
-                    user_obj.username, user_obj.password)
-            self._save()
-        return user_obj
+            ready, warming = self._collection.warm_counts
+            missing = self._config["warm_pool"] - ready - warming
+            if missing <= 0:
+                return
+            users = self._collection.reserve_free(missing, skip=self._removal_pending)
+            self._publish(*[user.username for user in users])
+            tasks = []
+            for user in users:
+                task = ChangeUserPassword(username=user.username, new_password=user.password,
+                                          retry=3, priority=PRIORITY_BULK)
+                self._warm_ups[user.username] = task.future
+                tasks.append(task)
+        for task in tasks:
+            task.future.add_done_callback(
+                lambda future, username=task.username: self._password_warmed(username, future))
+            self._thread_pool.queue_task(task)
+        if tasks:
+            log.info("Warming up %i users", len(tasks))
+
+    def _password_warmed(self, username, future):
+        """ Called (from the worker thread) when a warm pool user's password was set: queues
+        the (delayed) confirmation of its login profile. """
+        if future.cancelled():
+            return  # by `_cancel_warm_up` (note: the lock is held by the caller!)
+        with self._lock:
+            current = self._warm_ups.get(username, None) is future
+            if current:
+                del self._warm_ups[username]
+        if current and future.exception() is None:
+            task = ConfirmLoginProfile(username=username, retry=ConfirmLoginProfile.ATTEMPTS)
+            confirm_future = self._thread_pool.queue_task(task, delay=ConfirmLoginProfile.DELAY)
+            confirm_future.add_done_callback(
+                lambda confirm_future: self._warm_done(username, confirm_future))
+            return
+        # note: a user allocated / reset in the meantime is no longer warming (no-op)
+        self._warm_done(username, future)
+
+    def _warm_done(self, username, future):
+        """ Called (from the worker thread) when a warm pool user's login profile was
+        confirmed (or its warm-up failed). """
+        success = not future.cancelled() and future.exception() is None
+        if not success and not future.cancelled():
+            log.warning("Warming up %s failed: %s", username, str(future.exception()))
+        with self._lock:
+            self._collection.set_warmed(username, success)
+            self._publish(username)
+        with self._warm_cond:
+            self._warm_cond.notify_all()
+
+    def _cancel_warm_up(self, username):
+        """ Cancels the user's warm pool password change (if any). Returns its future if it
+        is already running: the next IAM changes of the user must be queued after it (see
+        `_queue_after`), else the warm password could override them. Note: use a lock before
+        calling this! """
+        future = self._warm_ups.pop(username, None)
+        if future is None or future.cancel() or future.done():
+            return None
+        return future
+
+    def _queue_after(self, task, after=None):
+        """ Queues a task (once the `after` future is done, if given) and returns its
+        future. """
+        if after is None:
+            return self._thread_pool.queue_task(task)
+        after.add_done_callback(lambda _: self._thread_pool.queue_task(task))
+        return task.future
+
+    def _removal_pending(self, username):
+        """ Checks whether the user's login profile removal is still pending. Note: use a lock
+        before calling this! """
+        future = self._removals.get(username, None)
+        if future is None:
+            return False
+        if future.done():
+            del self._removals[username]
+            return False
+        return True
+
+    def allocate_users(self, count=None, usernames=None):
+        """ Allocates `count` free users (the warm pool's first) or forcefully allocates the
+        given users (all of them in memory, then persisted at once).
+
+        Returns the list of results (`{"user": ..., "status": ..., "error": ...}`) whose IAM
+        passwords still need to be set by `provision_users`, the ready users are returned
+        with the "ready" status, the failed allocations with "failed". """
+        results = []
+        with self._lock:
+            if usernames is not None:
+                for username in usernames:
+                    try:
+                        user_obj = self._collection.allocate_custom(username)
+                    except StudentAccountException as exc:
+                        results.append({"username": username, "status": "failed",
+                                        "error": str(exc)})
+                        continue
+                    results.append({"user": user_obj, "status": "pending",
+                                    "after": self._cancel_warm_up(username)})
+            else:
+                for _ in range(count):
+                    user_obj = self._collection.allocate_ready()
+                    if user_obj is not None:
+                        results.append({"user": user_obj, "status": "ready"})
+                        continue
+                    try:
+                        user_obj = self._collection.allocate_user()
+                    except StudentAccountException as exc:
+                        results.append({"status": "failed", "error": str(exc)})
+                        break
+                    results.append({"user": user_obj, "status": "pending"})
+            self._persist(*[result["user"].username for result in results if "user" in result])
+        self._drain_writes()
+        if self.on_allocate and any(result["status"] == "ready" for result in results):
+            self.on_allocate()
+        return results
+
+    def provision_users(self, results):
+        """ Queues the IAM password changes of the allocated users right away (independently of
+        the caller consuming the results: at most `bulk_concurrency` of them are queued at
+        once, the next ones as they complete). Returns the list of `(result, future)` pairs
+        for `iter_provisioned` (the future is None if the result needs no provisioning). """
+        provisioning = []
+        pending = deque()
+        for result in results:
+            if result["status"] != "pending":
+                provisioning.append((result, None))
+                continue
+            user_obj = result["user"]
+            task = ChangeUserPassword(username=user_obj.username, new_password=user_obj.password,
+                                      retry=3, priority=PRIORITY_ADMIN)
+            pending.append((task, result.get("after", None)))
+            provisioning.append((result, task.future))
+        pending_lock = Lock()
+
+        def queue_next(future=None):
+            with pending_lock:
+                if future is not None and future.cancelled():
+                    # the pool was shut down: cancel the remaining ones
+                    for task, _ in pending:
+                        task.future.cancel()
+                    pending.clear()
+                if not pending:
+                    return
+                task, after = pending.popleft()
+            task.future.add_done_callback(queue_next)
+            self._queue_after(task, after)
+
+        for _ in range(min(len(pending), self._config["bulk_concurrency"])):
+            queue_next()
+        return provisioning
+
+    def iter_provisioned(self, provisioning):
+        """ Yields the results of `provision_users` as they complete ("provisioned" / "failed"
+        / "pending" - timed out, the password is still being set in background). """
+        inflight = {}
+        for result, future in provisioning:
+            if future is None:
+                yield result
+            else:
+                inflight[future] = result
+        while inflight:
+            done, _ = wait(inflight, timeout=self._config["timeout"],
+                           return_when=FIRST_COMPLETED)
+            if not done:
+                # don't block any longer (the remaining ones are still queued)
+                for result in inflight.values():
+                    result.update(status="pending", error="timed out (still in progress)")
+                    yield result
+                return
+            for future in done:
+                result = inflight.pop(future)
+                if future.cancelled():
+                    result.update(status="failed", error="cancelled")
+                elif future.exception() is not None:
+                    result.update(status="failed", error=str(future.exception()))
+                else:
+                    result["status"] = "provisioned"
+                yield result
 
     def reset_user(self, username):
         """ Resets an user account. """
         with self._lock:
             # queue the task to reset the user's profile, but don't wait for it
-            task = RemoveUserProfile(username=username, retry=3)
-            self._thread_pool.queue_task(task)
+            task = RemoveUserProfile(username=username, retry=3, priority=PRIORITY_ADMIN)
             self._collection.reset_user(username)
-            self._save()
+            self._removals[username] = self._queue_after(task, self._cancel_warm_up(username))
+            self._persist(username)
+        self._drain_writes()
 
     def reset_all_users(self):
         """ Resets all user accounts. """
         with self._lock:
-            for username in self._collection.get_users():
+            usernames = list(self._collection.get_users())
+            for username in usernames:
                 # queue the task to reset the user's profile, but don't wait for it
                 task = RemoveUserProfile(username=username, retry=3)
-                self._thread_pool.queue_task(task)
                 self._collection.reset_user(username)
-                self._save()
+                self._removals[username] = self._queue_after(
+                    task, self._cancel_warm_up(username))
+            self._persist(*usernames)
+        self._drain_writes()
 
     def _fetch_aws_users(self):
         """ Fetches the AWS users. """
-        task = RetrieveStudentUsers(pattern=self._config["pattern"])
-        task_future = self._thread_pool.queue_task(task)
+        task = RetrieveStudentUsers(
+            pattern=self._pattern, path_prefix=self._config["path_prefix"],
+            on_page=self._load_aws_page)
+        task_future = self._thread_pool.queue_task(task, dedupe_key="RetrieveStudentUsers")
         return task_future.result(timeout=self._config["timeout"])
 
-    def _change_aws_password(self, username, password):
-        """ Changes the AWS user's password (note: non blocking). """
+    def _load_aws_page(self, aws_users):
+        """ Loads a page of AWS users into the collection (called from the worker thread). """
+        with self._lock:
+            self._collection.load_aws(aws_users)
+            self._publish_all()
+
+    def _change_aws_password(self, username, password, priority=None, after=None):
+        """ Changes the AWS user's password (note: non blocking), after the `after` future is
+        done (if given). """
         # set a new password using the AWS IAM API
+        kwargs = {"priority": priority} if priority is not None else {}
         task = ChangeUserPassword(
             username=username, new_password=password,
-            retry=3)
+            retry=3, **kwargs)
         # queue a task to set the user's password, but don't wait for it
         # we need to return the token ASAP
-        return self._thread_pool.queue_task(task)
+        return self._queue_after(task, after)
+
+    def _persist(self, *usernames):
+        """ Queues the current state of the given users to be persisted by `_drain_writes`.
+        Note: use a lock before calling this! """
+        for username in usernames:
+            self._pending_writes.pop(username, None)
+            self._pending_writes[username] = \
+                self._collection.get_user(username).export(persistent=True)
+        self._persisted.update(usernames)
+        self._publish(*usernames)
+
+    def _publish(self, *usernames):
+        """ Publishes a new snapshot with the given users updated. Note: use a lock before
+        calling this! """
+        if usernames:
+            self._snapshot = self._snapshot.updated(
+                self._collection.get_user(username) for username in usernames)
+
+    def _publish_all(self):
+        """ Publishes a new snapshot of all users (unless nothing changed). Note: use a lock
+        before calling this! """
+        users = {username: self._collection.get_user(username).copy()
+                 for username in self._collection.get_users()}
+        if not self._snapshot.same_as(users):
+            self._snapshot = StudentAccountSnapshot(users, self._snapshot.version + 1)
+
+    @property
+    def version(self):
+        """ The version of the users snapshot (changes when any user changes). """
+        return self._snapshot.version
+
+    def _drain_writes(self):
+        """ Persists the queued rows (a single transaction). Call it after releasing the lock.
+        The drains are serialized, so the rows are written in order and the concurrent
+        changes are written together. """
+        with self._drain_lock:
+            with self._lock:
+                rows, self._pending_writes = self._pending_writes, OrderedDict()
+            if rows:
+                self._table.put_many(rows)
+
+    def _persist_new(self):
+        """ Persists the newly discovered AWS users. Note: use a lock before calling this! """
+        new_users = [username for username in self._collection.get_users()
+                     if username not in self._persisted]
+        if new_users:
+            self._persist(*new_users)
 
-    def _save(self):
-        """ Saves the users list to file. Note: use a lock before calling this! """
-        self._save_file({
-            "users": self._collection.export(persistent=True)
-        })
+    def flush(self):
+        """ Writes the pending changes (if the backend delays them). """
+        self._drain_writes()
+        self._table.flush()
@@ -0,0 +1,46 @@
+""" Cache of the encoded response payloads. """
+
+from threading import Lock
+from collections import OrderedDict
+
+from ._utils import AWS_ENCODER
+
+
+class ResponseCache():
+    """ LRU cache of JSON-encoded payloads. The keys must contain the versions of the data
+    used to build the payload (and the query shape), so the entries never need invalidation:
+    the outdated ones are simply evicted. """
+
+    def __init__(self, max_entries=32):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key, build, open_object=False):
+        """ Returns the cached payload or encodes the object returned by `build()`. With
+        `open_object`, the closing brace of the (dict) payload is left out, so the caller can
+        append more (e.g., per-request) members. """
+        with self._lock:
+            payload = self._entries.get(key, None)
+            if payload is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return payload
+            self.misses += 1
+        # note: built outside the lock (concurrent misses may encode the same payload)
+        payload = AWS_ENCODER.encode(build())
+        if open_object:
+            payload = payload[:-1]
+        payload = payload.encode("utf-8")
+        with self._lock:
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return payload
+
+    def get_stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,153 @@
+""" Per-endpoint request latency tracking (CherryPy tool). """
+
+import json
+import time
+import logging
+from threading import Lock
+from collections import deque
+
+import cherrypy
+
+from ..metrics import METRICS
+
+log = logging.getLogger("lib.web.slow_requests")
+
+SLOW_REQUEST_THRESHOLD = 1.0  # seconds
+LATENCY_WINDOW = 500  # number of samples retained per endpoint
+PERCENTILES = (50, 90, 99)
+
+REQUEST_DURATION = METRICS.histogram(
+    "http_request_duration_seconds", "Total duration of the HTTP requests",
+    labels=("endpoint",))
+REQUEST_BYTES = METRICS.counter(
+    "http_response_bytes_total", "Number of response body bytes sent", labels=("endpoint",))
+
+
+def percentile(sorted_values, pct):
+    """ Returns the (nearest-rank) percentile of a sorted list. """
+    if not sorted_values:
+        return None
+    rank = max(0, int(round(pct / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class EndpointLatency():
+    """ Rolling window of an endpoint's request timings. """
+
+    def __init__(self, window):
+        self.count = 0
+        self.slow = 0
+        self.bytes = 0
+        self._total = deque(maxlen=window)
+        self._handler = deque(maxlen=window)
+        self._serialize = deque(maxlen=window)
+
+    def add(self, total, handler, serialize, size, slow):
+        self.count += 1
+        self.bytes += size
+        self.slow += int(slow)
+        self._total.append(total)
+        self._handler.append(handler)
+        self._serialize.append(serialize)
+
+    def export(self):
+        result = {"count": self.count, "slow": self.slow, "bytes": self.bytes}
+        for name, samples in (("total", self._total), ("handler", self._handler),
+                              ("serialize", self._serialize)):
+            samples = sorted(samples)
+            result[name] = {"p%i" % pct: percentile(samples, pct) for pct in PERCENTILES}
+            result[name]["max"] = samples[-1] if samples else None
+        return result
+
+
+class LatencyTracker():
+    """ Keeps the rolling latency percentiles of each endpoint in memory and logs the requests
+    slower than the threshold. """
+
+    def __init__(self, slow_threshold=SLOW_REQUEST_THRESHOLD, window=LATENCY_WINDOW):
+        self.slow_threshold = slow_threshold
+        self._window = window
+        self._endpoints = {}
+        self._lock = Lock()
+
+    def record(self, endpoint, total, handler, serialize, size, status=None):
+        slow = self.slow_threshold is not None and total >= self.slow_threshold
+        with self._lock:
+            stats = self._endpoints.get(endpoint, None)
+            if stats is None:
+                stats = self._endpoints[endpoint] = EndpointLatency(self._window)
+            stats.add(total, handler, serialize, size, slow)
+        REQUEST_DURATION.observe(total, endpoint=endpoint)
+        REQUEST_BYTES.inc(size, endpoint=endpoint)
+        if slow:
+            log.warning("Slow request: %s", json.dumps({
+                "endpoint": endpoint,
+                "method": cherrypy.serving.request.method,
+                "status": status,
+                "total": round(total, 4),
+                "handler": round(handler, 4),
+                "serialize": round(serialize, 4),
+                "bytes": size,
+                "remote_ip": cherrypy.serving.request.remote.ip,
+            }, sort_keys=True))
+
+    def get_stats(self):
+        """ Returns the latency percentiles (in seconds) of each endpoint. """
+        with self._lock:
+            return {endpoint: stats.export() for endpoint, stats in self._endpoints.items()}
+
+
+class LatencyTool(cherrypy.Tool):
+    """ Measures the handler time, the (JSON) serialization time and the response size of
+    each request. The `json_handler` reports its own phases through `request.latency`. """
+
+    def __init__(self):
+        super().__init__("on_start_resource", self._on_start, priority=0)
+
+    def _setup(self):
+        conf = self._merged_args()
+        hooks = cherrypy.serving.request.hooks
+        hooks.attach("on_start_resource", self._on_start, priority=0)
+        # note: after the json_in / json_out tools
+        hooks.attach("before_handler", self._before_handler, priority=90)
+        hooks.attach("before_finalize", self._before_finalize, priority=10)
+        hooks.attach("on_end_request", self._on_end, priority=90, **conf)
+
+    @staticmethod
+    def _on_start():
+        request = cherrypy.serving.request
+        # note: the handler is not yet wrapped by the other tools (e.g., json_out / encode)
+        func = getattr(request.handler, "callable", None)
+        if func is None:
+            endpoint = request.script_name or "/"
+        else:
+            endpoint = "%s/%s" % (request.script_name, func.__name__)
+        request.latency = {"start": time.monotonic(), "endpoint": endpoint}
+
+    @staticmethod
+    def _before_handler():
+        cherrypy.serving.request.latency["handler_start"] = time.monotonic()
+
+    @staticmethod
+    def _before_finalize():
+        latency = cherrypy.serving.request.latency
+        if "handler_start" in latency:
+            latency.setdefault("handler", time.monotonic() - latency["handler_start"])
+
+    def _on_end(self, tracker=None):
+        request = cherrypy.serving.request
+        latency = getattr(request, "latency", None)
+        if tracker is None or latency is None:
+            return
+        response = cherrypy.serving.response
+        size = latency.get("bytes", None)
+        if size is None:
+            try:
+                size = int(response.headers.get("Content-Length", 0))
+            except ValueError:
+                size = 0
+        tracker.record(latency["endpoint"],
+                       total=time.monotonic() - latency["start"],
+                       handler=latency.get("handler", 0),
+                       serialize=latency.get("serialize", 0),
+                       size=size, status=response.status)
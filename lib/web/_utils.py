@@ -1,6 +1,7 @@
 """ Cherrypy extensions. """
 
 import json
+import time
 
 import cherrypy
 from ..aws.utils import AwsJsonEncoder
@@ -33,7 +34,18 @@ AWS_ENCODER = AwsJsonEncoder()
 
 
 def json_handler(*args, **kwargs):
-    value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
+    request = cherrypy.serving.request
+    start = time.monotonic()
+    value = request._json_inner_handler(*args, **kwargs)
+    # report the handler / serialization phases to the latency tool
+    latency = getattr(request, "latency", {})
+    latency["handler"] = time.monotonic() - start
+    start = time.monotonic()
+    size = 0
     for chunk in AWS_ENCODER.iterencode(value):
-        yield chunk.encode('utf-8')
+        chunk = chunk.encode('utf-8')
+        size += len(chunk)
+        yield chunk
+    latency["serialize"] = time.monotonic() - start
+    latency["bytes"] = size
 
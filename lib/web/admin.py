@@ -1,15 +1,20 @@
 """ Admin API controller """
 
 from collections.abc import Mapping
+import json
 import logging
 import cherrypy
 import cherrypy_cors
 from botocore.exceptions import ClientError
 
 from ..model.student_users import StudentAccountException
+from ..model.aws import RESOURCE_TYPES
+from ..store.jobs import JobRegistryException
 from ..aws.utils import get_aws_url
+from ..metrics import METRICS
 
-from ._utils import send_json_error, json_handler
+from ._utils import AWS_ENCODER, send_json_error, json_handler
+from ._cache import ResponseCache
 
 TASK_TIMEOUT = 30  # seconds
 
@@ -21,6 +26,7 @@ class AdminController():
         self._app = app
         self._store = app.store
         self._log = logging.getLogger("AdminController")
+        self._cache = ResponseCache()
 
         cherrypy.tree.mount(self, "/admin", self._cherry_config())
 
@@ -36,8 +42,13 @@ class AdminController():
         }
 
     def _check_authorization(self):
-        """ Check the authentication token of the admin. """
+        """ Check the authentication token of the admin (also accepted as bearer token, e.g.,
+        for the metrics scrapers). """
         auth_token = cherrypy.request.headers.get("X-Auth-Token", None)
+        if auth_token is None:
+            auth_header = cherrypy.request.headers.get("Authorization", "")
+            if auth_header.startswith("Bearer "):
+                auth_token = auth_header[len("Bearer "):].strip()
         if not self._store.admin.check_auth_token(auth_token):
             raise cherrypy.HTTPError(401, "Not Authenticated")
 
@@ -110,12 +121,6 @@ class AdminController():
 
         return {"success": True}
 
-    # @cherrypy.expose(alias="customAllocateUsers")
-    def custom_allocate_users(self):
-        """ For testing purposes. """
-        users = ["student35", "student36", "student37", "student38", "student39", "student40"]
-        self._store.users.allocate_custom_users(users)
-
     @cherrypy.expose(alias="getAwsData")
     def get_aws_data(self):
         """ Returns the AWS users and AWS resource stats. """
@@ -123,15 +128,166 @@ class AdminController():
             return
         self._check_authorization()
 
-        users = self._store.users.refresh_users()
-        self._store.resources.refresh_resources()
-        usernames = [user["username"] for user in users]
+        users_store, resources_store = self._store.users, self._store.resources
+        if not self._store.background_refresh:
+            users_store.refresh_users()
+            resources_store.refresh_resources()
+
+        def build():
+            users = users_store.export()
+            usernames = [user["username"] for user in users]
+            return {"users": users, "stats": resources_store.get_stats(usernames)}
+
+        # note: the versions are read before the data (so a newer payload may get cached under
+        # an older key, but never the other way around)
+        payload = self._cache.get_or_build(
+            ("getAwsData", users_store.version, resources_store.version), build,
+            open_object=True)
+        age = AWS_ENCODER.encode({
+            "users": users_store.get_age(),
+            "resources": resources_store.get_age(),
+        })
+        # splice the (per-request) age into the cached object
+        tail = (', "age": ' + age + '}').encode("utf-8")
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        getattr(cherrypy.serving.request, "latency", {})["bytes"] = len(payload) + len(tail)
+        return [payload, tail]
+    get_aws_data._cp_config = {"tools.json_out.on": False}
+
+    @cherrypy.expose(alias="getAwsChanges")
+    def get_aws_changes(self, since=0):
+        """ Returns the AWS resource changes since the given version (or the full resources if
+        the requested changes are no longer available). """
+        if self._check_preflight():
+            return
+        self._check_authorization()
+
+        try:
+            since = int(since)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid version")
+        resources_store = self._store.resources
+
+        def build():
+            version, changes = resources_store.get_changes(since)
+            if changes is None:
+                return {"version": version, "resources": resources_store.export()}
+            return {"version": version, "changes": changes}
+
+        payload = self._cache.get_or_build(
+            ("getAwsChanges", since, resources_store.version), build)
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        getattr(cherrypy.serving.request, "latency", {})["bytes"] = len(payload)
+        return payload
+    get_aws_changes._cp_config = {"tools.json_out.on": False}
+
+    @cherrypy.expose(alias="getAwsResource")
+    def get_aws_resource(self, type=None, id=None):
+        """ Returns the full AWS description of a resource (for debugging). """
+        if self._check_preflight():
+            return
+        self._check_authorization()
+
+        if type not in RESOURCE_TYPES or not id:
+            raise cherrypy.HTTPError(400, "Invalid resource type / ID")
+        try:
+            resource = self._store.resources.get_raw_resource(type, id)
+        except ClientError as err:
+            raise cherrypy.HTTPError(400, err.response["Error"]["Message"])
+        if not resource:
+            raise cherrypy.HTTPError(404, "Resource not found")
+        return resource
+
+    @cherrypy.expose(alias="getServerStats")
+    def get_server_stats(self):
+        """ Returns the server's internal statistics (e.g., the worker pool's). """
+        if self._check_preflight():
+            return
+        self._check_authorization()
 
         return {
-            "users": users,
-            "stats": self._store.resources.get_stats(usernames)
+            "pool": self._app.thread_pool.get_stats(),
+            "requests": self._app.latency.get_stats(),
+            "responseCache": self._cache.get_stats(),
         }
 
+    @cherrypy.expose(alias="reloadCredentials")
+    def reload_credentials(self):
+        """ Reloads the AWS credentials from the config files (e.g., after rotation). """
+        if self._check_preflight():
+            return
+        self._check_authorization()
+
+        if cherrypy.request.method != "POST":
+            raise cherrypy.HTTPError(400, "Invalid request (%s)" % cherrypy.request.method)
+        try:
+            self._app.reload_credentials()
+        except Exception as exc:
+            self._log.exception("Reloading the AWS credentials failed")
+            raise cherrypy.HTTPError(500, "Reloading the config failed: %s" % str(exc))
+        return {"success": True}
+
+    @cherrypy.expose()
+    def metrics(self):
+        """ Returns the server's metrics in the Prometheus text format. """
+        if self._check_preflight():
+            return
+        self._check_authorization()
+
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return METRICS.render().encode("utf-8")
+    metrics._cp_config = {"tools.json_out.on": False}
+
+    @cherrypy.expose(alias="allocateUsers")
+    def allocate_users(self):
+        """ Allocates multiple accounts (`count` free ones or the given `usernames`) and streams
+        their credentials + provisioning status back as newline-delimited JSON (the last line
+        is a summary). """
+        if self._check_preflight():
+            return
+        self._check_authorization()
+
+        if cherrypy.request.method != "POST":
+            raise cherrypy.HTTPError(400, "Invalid request (%s)" % cherrypy.request.method)
+        args = cherrypy.request.json
+        if not isinstance(args, Mapping):
+            raise cherrypy.HTTPError(400, "Invalid request data")
+        usernames = args.get("usernames", None)
+        count = args.get("count", None)
+        if usernames is not None:
+            if not isinstance(usernames, list) or not all(
+                    isinstance(username, str) for username in usernames):
+                raise cherrypy.HTTPError(400, "Invalid usernames list")
+            count = None
+        elif isinstance(count, bool) or not isinstance(count, int) or count <= 0:
+            raise cherrypy.HTTPError(400, "Invalid accounts count")
+
+        results = self._store.users.allocate_users(count=count, usernames=usernames)
+        self._log.info("Bulk allocated %i users", sum(1 for res in results if "user" in res))
+        # note: queued before streaming, so a disconnected client doesn't stop the provisioning
+        provisioning = self._store.users.provision_users(results)
+
+        cherrypy.response.headers["Content-Type"] = "application/x-ndjson"
+        return self._stream_allocations(provisioning)
+    allocate_users._cp_config = {"tools.json_out.on": False, "response.stream": True}
+
+    def _stream_allocations(self, provisioning):
+        url = get_aws_url(self._app.config["aws"])
+        counts = {}
+        for result in self._store.users.iter_provisioned(provisioning):
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+            user_obj = result.get("user", None)
+            line = {"status": result["status"]}
+            if user_obj:
+                line.update(username=user_obj.username, token=user_obj.alloc_token,
+                            password=user_obj.password, url=url)
+            elif result.get("username"):
+                line["username"] = result["username"]
+            if result.get("error"):
+                line["error"] = result["error"]
+            yield (json.dumps(line) + "\n").encode("utf-8")
+        yield (json.dumps({"done": True, "counts": counts}) + "\n").encode("utf-8")
+
     @cherrypy.expose(alias="deallocateUser")
     def deallocate_user(self):
         """ Deallocates a specific user or all of them. """
@@ -171,17 +327,31 @@ class AdminController():
         if all:
             username = None
 
-        errors = self._store.resources.clean_aws_resources(username)
-        if errors:
-            error_msgs = ["Warning: the instances take longer to stop and cause other resources "
-                          "to appear as busy." +
-                          "Please try the cleanup process again after 30 seconds.\n"]
-            for err in errors:
-                if isinstance(err, ClientError):
-                    error_msgs.append(str(err.operation_name) + ": " +
-                                      err.response["Error"]["Message"])
-                else:
-                    error_msgs.append(str(err))
-            raise cherrypy.HTTPError(500, "\n".join(error_msgs))
-        return {"success": True}
+        try:
+            job = self._store.resources.start_cleanup(username)
+        except JobRegistryException as exc:
+            raise cherrypy.HTTPError(503, str(exc))
+        return {"success": True, "jobId": job.id}
+
+    @cherrypy.expose(alias="getCleanupJob")
+    def get_cleanup_job(self, id=None):
+        """ Returns the progress of a cleanup job. """
+        if self._check_preflight():
+            return
+        self._check_authorization()
+
+        job = self._store.resources.get_cleanup_job(id)
+        if not job:
+            raise cherrypy.HTTPError(404, "Cleanup job not found")
+        result = job.export()
+        if result["errors"] and job.done:
+            if self._store.resources.converge_cleanup:
+                error_msgs = ["Warning: some resources could not be deleted before the "
+                              "cleanup deadline.\n"]
+            else:
+                error_msgs = ["Warning: the instances take longer to stop and cause other "
+                              "resources to appear as busy." +
+                              "Please try the cleanup process again after 30 seconds.\n"]
+            result["message"] = "\n".join(error_msgs + result["errors"])
+        return result
 
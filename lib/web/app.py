@@ -4,7 +4,10 @@ import os
 import cherrypy
 import cherrypy_cors
 
+from ..config import load_config
+from ..aws.worker import DRAIN_TIMEOUT
 from ._utils import send_json_error
+from ._latency import LatencyTool, LatencyTracker, SLOW_REQUEST_THRESHOLD, LATENCY_WINDOW
 from .student import StudentController
 from .admin import AdminController
 
@@ -18,6 +21,15 @@ class AwsWebApp():
         self._store = store
 
         cherrypy_cors.install()
+        self._latency = LatencyTracker(
+            slow_threshold=self._config["server"].get("slow_request_threshold",
+                                                      SLOW_REQUEST_THRESHOLD),
+            window=self._config["server"].get("latency_window", LATENCY_WINDOW))
+        cherrypy.tools.latency = LatencyTool()
+        cherrypy.config.update({
+            "tools.latency.on": True,
+            "tools.latency.tracker": self._latency,
+        })
         cherrypy.tree.mount(self, "/", self._cherry_config())
         self._student = StudentController(app=self)
         self._admin = AdminController(app=self)
@@ -25,6 +37,7 @@ class AwsWebApp():
             os.path.abspath(os.getcwd()),
             self._config["server"]["static_path"])
 
+        cherrypy.engine.subscribe('start', self._on_start)
         cherrypy.engine.subscribe('stop', self._on_stop)
 
         self._init_users()
@@ -34,9 +47,23 @@ class AwsWebApp():
         cherrypy.engine.start()
         cherrypy.engine.block()
 
+    def _on_start(self):
+        """ On start handler to start the stores' background tasks. """
+        self._store.start()
+
     def _on_stop(self):
-        """ On stop handler to wait for the thread pool to exit. """
-        self._pool.join()
+        """ On stop handler to drain the thread pool (within the configured timeout), then stop
+        the stores (the drained tasks' callbacks may still write to them). """
+        self._pool.join(timeout=self._config["server"].get("drain_timeout", DRAIN_TIMEOUT))
+        self._store.stop()
+
+    def reload_credentials(self):
+        """ Reloads the AWS credentials / options from the config files (e.g., after rotation)
+        and invalidates the workers' cached clients. """
+        config = load_config()
+        if not isinstance(config.get("aws", None), dict):
+            raise ValueError("the config has no 'aws' section")
+        self._pool.invalidate_clients(config["aws"])
 
     @property
     def store(self):
@@ -46,6 +73,10 @@ class AwsWebApp():
     def thread_pool(self):
         return self._pool
 
+    @property
+    def latency(self):
+        return self._latency
+
     @property
     def config(self):
         return self._config
@@ -8,7 +8,7 @@ import cherrypy_cors
 from ..model.student_users import StudentAccountException
 from ..aws.utils import get_aws_url
 
-from ._utils import send_json_error
+from ._utils import send_json_error, json_handler
 
 TASK_TIMEOUT = 30  # seconds
 
@@ -30,6 +30,7 @@ class StudentController():
                 'cors.expose.on': True,
                 'tools.json_in.on': True,
                 'tools.json_out.on': True,
+                'tools.json_out.handler': json_handler,
             }
         }
 
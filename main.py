@@ -3,14 +3,21 @@
 from lib.config import load_config
 from lib.logging import configure_logging
 from lib.web import AwsWebApp
-from lib.aws.worker import ThreadPool
+from lib.aws.worker import ThreadPool, TASK_AGING, WORKER_IDLE_TIMEOUT, GROW_LATENCY
+from lib.aws.retry import RetryPolicy
 from lib.store import ApplicationStore
 
 
 if __name__ == '__main__':
     config = load_config()
     configure_logging()
-    thread_pool = ThreadPool(config["server"]["workers"], config["aws"])
+    thread_pool = ThreadPool(config["server"]["workers"], config["aws"],
+                             aging=config["server"].get("task_aging", TASK_AGING),
+                             retry_policy=RetryPolicy(**config["server"].get("retry", {})),
+                             max_threads=config["server"].get("max_workers", None),
+                             idle_timeout=config["server"].get("worker_idle_timeout",
+                                                               WORKER_IDLE_TIMEOUT),
+                             grow_latency=config["server"].get("grow_latency", GROW_LATENCY))
     store = ApplicationStore(config.get("data_store", {}), thread_pool)
 
     app = AwsWebApp(config=config, store=store, thread_pool=thread_pool)
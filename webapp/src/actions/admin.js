@@ -9,6 +9,7 @@ export const ADMIN_UPDATE_AWS = 'ADMIN_UPDATE_AWS';
 export const ADMIN_UPDATE_ACTION = 'ADMIN_UPDATE_ACTION';
 
 const refreshTime = 10; // seconds
+const cleanupPollTime = 2; // seconds
 
 let adminModel = null;
 let modelPromise = loadConfig().then((apiConfig) => {
@@ -156,6 +157,9 @@ export const cleanAwsResources = (username, all) => (dispatch) => {
   }
   dispatch(setActionResults("cleanAwsResources", {loading: true}));
   adminModel.cleanAwsResources(username, all)
+    .then((resp) => {
+      return _waitCleanupJob(resp.jobId);
+    })
     .then(() => {
       dispatch(setActionResults('cleanAwsResources', {success: true}));
       dispatch(fetchAwsData());
@@ -165,6 +169,21 @@ export const cleanAwsResources = (username, all) => (dispatch) => {
     });
 };
 
+// polls the cleanup job until it finishes
+const _waitCleanupJob = (jobId) => {
+  return new Promise((resolve) => {
+    setTimeout(resolve, cleanupPollTime * 1000);
+  }).then(() => {
+    return adminModel.getCleanupJob(jobId);
+  }).then((job) => {
+    if (job.status == "running")
+      return _waitCleanupJob(jobId);
+    if (job.status != "finished")
+      throw job.message || job.errors.join("\n");
+    return job;
+  });
+};
+
 export const deallocateUser = (username, all) => (dispatch) => {
   if (!adminModel) {
     dispatch(showAppError(modelError));
@@ -90,6 +90,21 @@ export class RLAwsAdmin extends RLAwsAPI {
       });
   }
 
+  allocateUsers(count, usernames) {
+    let reqArgs = usernames ? {usernames: usernames} : {count: count};
+    return this.post("/admin/allocateUsers")
+      .send(reqArgs)
+      .then((resp) => {
+        // newline-delimited JSON (the last line is the summary)
+        let lines = resp.text.split("\n").filter((line) => !!line);
+        let results = lines.map((line) => JSON.parse(line));
+        let summary = results.pop();
+        return { accounts: results, counts: summary.counts };
+      }, (err) => {
+        throw this._errorMessage(err);
+      });
+  }
+
   cleanAwsResources(username, all) {
     let reqArgs = all ? {all: true} : {username: username};
     return this.post("/admin/cleanAwsResources")
@@ -101,6 +116,15 @@ export class RLAwsAdmin extends RLAwsAPI {
       });
   }
 
+  getCleanupJob(jobId) {
+    return this.get("/admin/getCleanupJob", {id: jobId})
+      .then((resp) => {
+        return resp.body;
+      }, (err) => {
+        throw this._errorMessage(err);
+      });
+  }
+
   logout() {
     this.resetCredentials();
     return Promise.resolve(true);